@@ -1,10 +1,13 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from flask_migrate import Migrate
 from config import Config
+from .replica import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
+migrate = Migrate()
 
 def create_app():
 
@@ -12,16 +15,56 @@ def create_app():
     app.config.from_object(Config)
 
     db.init_app(app)
+    from .replica import replicas
+    replicas.init_app(app)
+    migrate.init_app(app, db)
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
 
+    from .metrics import metrics
+    metrics.init_app(app)
+
+    from .profiler import profiler
+    profiler.init_app(app)
+
+    from . import stats
+    stats.init_app(app)
+
+    from .users import users
+    users.init_app(app)
+
+    from .pages import pages
+    pages.init_app(app)
+
+    from .counters import counters
+    counters.init_app(app)
+
+    from .pdf import jobs, cache
+    jobs.init_app(app)
+    cache.init_app(app)
+
+    from .scheduler import scheduler
+    from .analytics import refresh_reports
+    scheduler.init_app(app)
+    scheduler.add('loan_reports', refresh_reports, app.config.get('REPORTS_INTERVAL', 900), midnight=True)
+
     from .routes import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
+    from .search import index
+    index.init_app(app)
+
+    from .suggest import book_titles, course_names
+    book_titles.init_app(app)
+    course_names.init_app(app)
+
+    from .ingest import ingest
+    app.cli.add_command(ingest)
+
     return app
 
 @login_manager.user_loader
 def load(id):
-    from .models import Utente
-    return db.session.get(Utente, int(id))
+    from .users import users
+    return users.get(int(id))
 
@@ -0,0 +1,149 @@
+from sqlalchemy import and_, case, delete, event, func, insert, or_
+from sqlalchemy.orm import Session, joinedload
+from datetime import date, datetime, timedelta
+from .models import Prestito, PrestitoGiornaliero, GiornoModificato
+from . import db
+
+UNUSUAL = 90
+
+def day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+def duration():
+    # (rientro - uscita) in giorni, nel dialetto del database in uso
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return func.julianday(Prestito.rientro) - func.julianday(Prestito.uscita)
+    if dialect == 'postgresql':
+        return Prestito.rientro - Prestito.uscita
+    return func.datediff(Prestito.rientro, Prestito.uscita)
+
+def overdue_query(today=None):
+    today = today or date.today()
+    return Prestito.query.filter(Prestito.rientro < today, Prestito.restituito == "No")
+
+def unusual_query():
+    return Prestito.query.filter(duration() > UNUSUAL)
+
+def expiring_query(today=None):
+    today = today or date.today()
+    return Prestito.query.filter(Prestito.rientro <= today + timedelta(days=7), Prestito.rientro >= today)
+
+# Ultima fotografia dei prestiti in scadenza, scaduti e insoliti, ricalcolata dallo scheduler
+reports = {}
+
+def refresh_reports(today=None):
+    today = today or date.today()
+    ids = lambda query: [id for id, in query.with_entities(Prestito.id).order_by(Prestito.id)]
+    reports['current'] = {'day': today, 'expiring': ids(expiring_query(today)), 'overdue': ids(overdue_query(today)),
+        'unusual': ids(unusual_query())}
+
+def stale(today=None):
+    snapshot = reports.get('current')
+    return not snapshot or snapshot['day'] != (today or date.today())
+
+def loan_report(name, today=None):
+    # Carica per chiave primaria i prestiti della fotografia e scarta quelli cambiati nel frattempo
+    today = today or date.today()
+    if stale(today):
+        refresh_reports(today)
+    snapshot = reports['current']
+    ids = snapshot[name]
+    if not ids:
+        return []
+    loans = Prestito.query.options(joinedload(Prestito.libro), joinedload(Prestito.utente)) \
+        .filter(Prestito.id.in_(ids)).order_by(Prestito.id).all()
+    still = {
+        'expiring': lambda loan: today <= day(loan.rientro) <= today + timedelta(days=7),
+        'overdue': lambda loan: day(loan.rientro) < today and loan.restituito == "No",
+        'unusual': lambda loan: (day(loan.rientro) - day(loan.uscita)).days > UNUSUAL
+    }[name]
+    return [loan for loan in loans if still(loan)]
+
+def rollup(days):
+    # Un solo GROUP BY per tutti i giorni richiesti; i giorni senza prestiti restano a zero
+    total = duration()
+    rows = db.session.query(Prestito.uscita, func.count(Prestito.id), func.sum(total),
+        func.sum(case((total > UNUSUAL, 1), else_=0))) \
+        .filter(Prestito.uscita.in_(days)).group_by(Prestito.uscita).all()
+    totals = {day(uscita): (count, round(giorni or 0), insoliti or 0) for uscita, count, giorni, insoliti in rows}
+    PrestitoGiornaliero.query.filter(PrestitoGiornaliero.giorno.in_(days)).delete(synchronize_session=False)
+    db.session.add_all(PrestitoGiornaliero(giorno=d, prestiti=p, giorni=g, insoliti=i)
+        for d, (p, g, i) in ((d, totals.get(d, (0, 0, 0))) for d in days))
+
+def refresh(today=None):
+    # Porta il riepilogo fino a ieri: i giorni nuovi e quelli modificati dopo l'ultimo calcolo
+    today = today or date.today()
+    # I giorni segnati fino a qui; quelli segnati durante il ricalcolo hanno un id più alto e restano per il prossimo giro
+    marked = db.session.query(func.max(GiornoModificato.id)).scalar()
+    days = set()
+    if marked:
+        days = {day(giorno) for giorno, in db.session.query(GiornoModificato.giorno)
+            .filter(GiornoModificato.id <= marked, GiornoModificato.giorno < today).distinct()}
+    last = db.session.query(func.max(PrestitoGiornaliero.giorno)).scalar()
+    first = day(last) + timedelta(days=1) if last else \
+        day(db.session.query(func.min(Prestito.uscita)).scalar() or today)
+    if first < today:
+        missing = db.session.query(Prestito.uscita).filter(Prestito.uscita >= first, Prestito.uscita < today).distinct().all()
+        days.update(day(uscita) for uscita, in missing)
+        # Anche se ieri non ci sono stati prestiti, la riga segna fin dove arriva il riepilogo
+        days.add(today - timedelta(days=1))
+    if not days:
+        return
+    try:
+        rollup(sorted(days))
+        if marked:
+            db.session.execute(delete(GiornoModificato).where(GiornoModificato.id <= marked, GiornoModificato.giorno < today))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def loan_stats(today=None):
+    today = today or date.today()
+    refresh(today)
+
+    loans, days, unusual = db.session.query(func.sum(PrestitoGiornaliero.prestiti), func.sum(PrestitoGiornaliero.giorni),
+        func.sum(PrestitoGiornaliero.insoliti)).filter(PrestitoGiornaliero.giorno < today).one()
+
+    # Un solo passaggio sui prestiti di oggi/futuri e su quelli ancora aperti
+    total = duration()
+    new = Prestito.uscita >= today
+    recent, recent_days, recent_unusual, overdue, current = db.session.query(
+        func.sum(case((new, 1), else_=0)),
+        func.sum(case((new, total), else_=0)),
+        func.sum(case((and_(new, total > UNUSUAL), 1), else_=0)),
+        func.sum(case((and_(Prestito.rientro < today, Prestito.restituito == "No"), 1), else_=0)),
+        func.sum(case((Prestito.rientro >= today, 1), else_=0)),
+    ).filter(or_(new, Prestito.rientro >= today, Prestito.restituito == "No")).one()
+
+    tloans = (loans or 0) + (recent or 0)
+    return {
+        'tloans': tloans,
+        'average_duration': ((days or 0) + (recent_days or 0)) / tloans if tloans else 0,
+        'overdue_loans_count': overdue or 0,
+        'current_loans_count': current or 0,
+        'unusual_loans_count': (unusual or 0) + (recent_unusual or 0)
+    }
+
+def touch_day(session, uscita):
+    # Anche per gli UPDATE diretti sui prestiti, che non passano dal flush dell'ORM
+    session.info.setdefault('loan_days', set()).add(day(uscita))
+
+@event.listens_for(Session, 'before_flush')
+def track(session, context, instances):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Prestito) and obj.uscita:
+            touch_day(session, obj.uscita)
+
+@event.listens_for(Session, 'before_commit')
+def mark(session):
+    # Nella stessa transazione della modifica: se il processo si ferma prima del ricalcolo, i giorni restano segnati
+    session.flush()
+    days = session.info.pop('loan_days', None)
+    if days:
+        session.execute(insert(GiornoModificato), [{'giorno': d} for d in sorted(days)])
+
+@event.listens_for(Session, 'after_rollback')
+def forget(session):
+    session.info.pop('loan_days', None)
@@ -0,0 +1,69 @@
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
+from . import db
+import atexit, os, threading
+
+class Counters:
+    # Accumula in memoria gli incrementi di viste/download e li scrive a intervalli
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.counts = {}
+        self.app = None
+        self.thread = None
+        self.pid = None
+        self.interval = 10
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('COUNTER_FLUSH', self.interval)
+        atexit.register(self.flush)
+
+    def incr(self, model, column, id, n=1):
+        with self.lock:
+            key = (model, column, id)
+            self.counts[key] = self.counts.get(key, 0) + n
+        # Con COUNTER_FLUSH = 0 si scrive subito, come prima
+        if not self.interval:
+            return self.flush()
+        self.start()
+
+    def start(self):
+        # Un thread per processo: dopo un fork va ricreato
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='counters', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.wake.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if not counts or not self.app:
+            return
+
+        # Un solo UPDATE ... SET col = col + n per ogni gruppo di righe con lo stesso incremento
+        groups = {}
+        for (model, column, id), n in counts.items():
+            groups.setdefault((model, column, n), []).append(id)
+        with self.app.app_context():
+            try:
+                for (model, column, n), ids in groups.items():
+                    field = getattr(model, column)
+                    db.session.execute(update(model).where(model.id.in_(ids)).values({column: field + n}))
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                self.app.logger.warning("Contatori non salvati, nuovo tentativo al prossimo flush: %s", e)
+                with self.lock:
+                    for key, n in counts.items():
+                        self.counts[key] = self.counts.get(key, 0) + n
+
+counters = Counters()
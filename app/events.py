@@ -0,0 +1,38 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Callback da chiamare dopo ogni commit che tocca certi modelli
+listeners = []
+
+def on_commit(*models):
+    def decorator(f):
+        listeners.append((models, f))
+        return f
+    return decorator
+
+def counters(model):
+    # Chiave a parte per gli UPDATE che cambiano solo copie e posti: chi mostra il catalogo non li ascolta
+    return (model, 'counters')
+
+def touch(session, model, id):
+    # Per le scritture fatte con UPDATE diretti, che non passano dal flush dell'ORM
+    session.info.setdefault('touched', set()).add((model, id))
+
+@event.listens_for(Session, 'after_flush')
+def collect(session, context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        touch(session, type(obj), getattr(obj, 'id', None))
+
+@event.listens_for(Session, 'after_commit')
+def notify(session):
+    touched = session.info.pop('touched', None)
+    if not touched:
+        return
+    for models, f in listeners:
+        changes = {(model, id) for model, id in touched if model in models}
+        if changes:
+            f(changes)
+
+@event.listens_for(Session, 'after_rollback')
+def discard(session):
+    session.info.pop('touched', None)
@@ -0,0 +1,81 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from .models import Utente, Libro, Corso, Prestito, Booking
+from . import db
+import csv, io, json
+
+CHUNK = 1000
+
+def loans(args):
+    query = db.session.query(Prestito.id, Prestito.uscita, Prestito.rientro, Prestito.terminato, Prestito.restituito,
+        Prestito.prorogato, Prestito.libro_id, Libro.titolo, Prestito.utente_id, Utente.nome, Utente.email) \
+        .join(Libro, Libro.id == Prestito.libro_id).join(Utente, Utente.id == Prestito.utente_id)
+    today = date.today()
+    # Gli stessi filtri delle pagine HTML: loverdue, lexpiring, luhistory e lbhistory
+    if args.get('filter') == 'overdue':
+        query = query.filter(Prestito.rientro < today, Prestito.restituito == "No")
+    elif args.get('filter') == 'expiring':
+        query = query.filter(Prestito.rientro <= today + timedelta(days=7), Prestito.rientro >= today)
+    if args.get('utente', type=int):
+        query = query.filter(Prestito.utente_id == args.get('utente', type=int))
+    if args.get('libro', type=int):
+        query = query.filter(Prestito.libro_id == args.get('libro', type=int))
+    return query.order_by(Prestito.id)
+
+def books(args):
+    query = db.session.query(Libro.id, Libro.titolo, Libro.autore, Libro.anno, Libro.genere, Libro.collana, Libro.editore,
+        Libro.classificazione, Libro.posizione, Libro.copie, Libro.disponibile, Libro.rivista, Libro.viste, Libro.download)
+    if args.get('genere'):
+        query = query.filter(Libro.genere == args.get('genere'))
+    if args.get('autore'):
+        query = query.filter(Libro.autore == args.get('autore'))
+    return query.order_by(Libro.id)
+
+def users(args):
+    query = db.session.query(Utente.id, Utente.nome, Utente.email, Utente.telefono, Utente.ruolo, Utente.genere)
+    if args.get('ruolo'):
+        query = query.filter(Utente.ruolo == args.get('ruolo'))
+    return query.order_by(Utente.id)
+
+def payments(args):
+    query = db.session.query(Booking.id, Utente.nome.label('utente'), Utente.email, Corso.nome.label('corso'), Corso.prezzo,
+        Corso.tessera, Booking.bdate.label('data_prenotazione'), Booking.state) \
+        .join(Corso, Corso.id == Booking.corso_id).join(Utente, Utente.id == Booking.utente_id)
+    if args.get('state'):
+        query = query.filter(Booking.state == args.get('state'))
+    if args.get('utente', type=int):
+        query = query.filter(Booking.utente_id == args.get('utente', type=int))
+    return query.order_by(Booking.id)
+
+EXPORTS = {'loans': loans, 'books': books, 'users': users, 'payments': payments}
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def value(v):
+    if isinstance(v, (date, datetime)):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return str(v)
+    return v
+
+def stream(query, fmt):
+    # Cursore lato server e righe a blocchi: la memoria non cresce con il numero di righe
+    result = query.execution_options(stream_results=True, yield_per=CHUNK)
+    keys = [column['name'] for column in query.column_descriptions]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(keys)
+
+    count = 0
+    for row in result:
+        values = [value(v) for v in row]
+        if fmt == 'csv':
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(keys, values)), ensure_ascii=False) + '\n')
+        count += 1
+        if count % CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
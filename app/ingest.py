@@ -0,0 +1,161 @@
+from sqlalchemy import insert, tuple_, update
+from flask.cli import with_appcontext
+from flask import current_app
+from .models import Libro
+from . import db
+import click, csv, json, os, time
+
+REQUIRED = ['titolo', 'classificazione', 'posizione', 'autore', 'genere', 'editore']
+OPTIONAL = ['collana', 'note']
+FLAGS = ['disponibile', 'libro_mese', 'rivista']
+NUMBERS = ['anno', 'copie', 'viste', 'download']
+KEY = ['titolo', 'autore', 'editore']
+
+def read(path, fmt):
+    # Una riga alla volta, con il numero di riga per i messaggi d'errore
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                yield line, row
+        else:
+            for line, text in enumerate(f, start=1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except ValueError as e:
+                        yield line, e
+
+def flag(value):
+    value = str(value).strip().casefold()
+    if value in ('si', 'sì', 'true', '1', 'yes'):
+        return True
+    if value in ('no', 'false', '0'):
+        return False
+    raise ValueError(f"valore non valido '{value}' (Si/No)")
+
+def validate(row):
+    # Restituisce solo le colonne presenti nel file, così un aggiornamento non azzera le altre
+    if not isinstance(row, dict):
+        raise ValueError(str(row) if isinstance(row, Exception) else 'la riga non è un oggetto')
+    values = {}
+    for name in REQUIRED:
+        value = str(row.get(name) or '').strip()
+        if not value:
+            raise ValueError(f"campo '{name}' mancante")
+        if len(value) > 255:
+            raise ValueError(f"campo '{name}' più lungo di 255 caratteri")
+        values[name] = value
+    for name in OPTIONAL:
+        if name in row:
+            values[name] = str(row[name] if row[name] is not None else '').strip() or None
+    for name in NUMBERS:
+        if name in row and str(row[name] if row[name] is not None else '').strip():
+            try:
+                values[name] = int(str(row[name]).strip())
+            except ValueError:
+                raise ValueError(f"campo '{name}' non numerico")
+            if not 0 <= values[name] <= (32767 if name == 'anno' else 2 ** 31 - 1):
+                raise ValueError(f"campo '{name}' fuori intervallo")
+    for name in FLAGS:
+        if name in row and str(row[name] if row[name] is not None else '').strip():
+            try:
+                values[name] = flag(row[name])
+            except ValueError as e:
+                raise ValueError(f"campo '{name}': {e}")
+    if 'copie' in values and 'disponibile' not in values:
+        values['disponibile'] = values['copie'] > 0
+    return values
+
+def defaults(values):
+    # Valori di un libro nuovo, come in bcreate
+    row = {'anno': None, 'collana': None, 'note': None, 'copie': 1, 'libro_mese': False, 'rivista': False, 'viste': 0, 'download': 0}
+    row.update(values)
+    row.setdefault('disponibile', row['copie'] > 0)
+    return row
+
+def write(chunk, key):
+    # Un SELECT per trovare i libri già presenti, poi un executemany per gli INSERT e uno per gli UPDATE
+    columns = [getattr(Libro, name) for name in key]
+    existing = dict((tuple(row[1:]), row[0]) for row in db.session.query(Libro.id, *columns)
+        .filter(tuple_(*columns).in_(list(chunk))).all())
+    new = [defaults(values) for k, values in chunk.items() if k not in existing]
+    changed = [dict(values, id=existing[k]) for k, values in chunk.items() if k in existing]
+    if new:
+        db.session.execute(insert(Libro), new)
+    if changed:
+        db.session.execute(update(Libro), changed)
+    db.session.commit()
+    return len(new), len(changed)
+
+def invalidate(genres, updated):
+    # Una sola invalidazione alla fine del caricamento, tramite i file di versione condivisi:
+    # i processi web ricostruiscono ricerca, suggerimenti e statistiche alla prossima richiesta
+    from .search import index
+    from .suggest import book_titles
+    from .stats import dashboard
+    from .pdf import cache
+    from .pages import pages
+    index.invalidate()
+    book_titles.invalidate()
+    dashboard.invalidate('books', 'month')
+    pages.invalidate()
+    if updated:
+        # I PDF dei singoli libri aggiornati: più semplice svuotare la cache che cercarli uno per uno
+        cache.clear()
+    else:
+        cache.invalidate(*(f'genre-{genre}' for genre in genres))
+
+@click.command('ingest')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Formato del file (di default dall\'estensione).')
+@click.option('--chunk', type=int, help='Righe per ogni executemany e commit (INGEST_CHUNK).')
+@click.option('--key', default=','.join(KEY), show_default=True, help='Colonne della chiave naturale per l\'upsert.')
+@click.option('--errors', default=20, show_default=True, help='Quanti errori di validazione mostrare.')
+@with_appcontext
+def ingest(path, fmt, chunk, key, errors):
+    """Carica o aggiorna libri da un file CSV o JSON Lines."""
+    fmt = fmt or ('jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson', '.json') else 'csv')
+    size = chunk or current_app.config.get('INGEST_CHUNK', 5000)
+    key = [name.strip() for name in key.split(',') if name.strip()]
+    unknown = [name for name in key if name not in Libro.__table__.columns]
+    if unknown:
+        raise click.BadParameter(f"colonne sconosciute: {', '.join(unknown)}", param_hint='--key')
+
+    start = time.perf_counter()
+    read_rows = inserted = updated = skipped = 0
+    pending = {}
+    genres = set()
+
+    def flush():
+        nonlocal inserted, updated
+        new, changed = write(pending, key)
+        inserted += new
+        updated += changed
+        pending.clear()
+        elapsed = time.perf_counter() - start
+        click.echo(f'{read_rows} righe lette, {inserted} inserite, {updated} aggiornate, {skipped} scartate '
+            f'({read_rows / elapsed:.0f} righe/s)')
+
+    for line, row in read(path, fmt):
+        read_rows += 1
+        try:
+            values = validate(row)
+            natural = tuple(values.get(name) for name in key)
+            if None in natural:
+                raise ValueError(f"chiave naturale incompleta ({', '.join(key)})")
+        except ValueError as e:
+            skipped += 1
+            if skipped <= errors:
+                click.echo(f'Riga {line}: {e}', err=True)
+            continue
+        # Se la stessa chiave compare due volte nello stesso blocco vale l'ultima riga
+        pending[natural] = values
+        genres.add(values['genere'])
+        if len(pending) >= size:
+            flush()
+    if pending:
+        flush()
+
+    invalidate(genres, updated)
+    elapsed = time.perf_counter() - start
+    click.echo(f'Fatto in {elapsed:.1f}s: {inserted} inseriti, {updated} aggiornati, {skipped} scartati.')
@@ -0,0 +1,234 @@
+from sqlalchemy import case, delete, func, text, update
+from sqlalchemy.exc import OperationalError
+from .models import Libro, Corso, Prestito, Booking
+from .events import counters, touch
+from .analytics import touch_day
+from . import db
+from datetime import date
+import random, time
+
+ATTEMPTS = 5
+
+def deadlock(e):
+    # MySQL 1213/1205, PostgreSQL 40P01/40001, SQLite "database is locked"
+    orig = getattr(e, 'orig', None)
+    code = getattr(orig, 'pgcode', None) or (orig.args[0] if getattr(orig, 'args', None) else None)
+    return code in (1213, 1205, '40P01', '40001') or 'locked' in str(orig)
+
+def transaction(f, *args):
+    # Esegue f in una transazione e la ripete da capo se il database la sceglie come vittima di un deadlock.
+    # Se f restituisce un valore falso un passo non è riuscito: si annulla tutto, anche i passi già fatti
+    for attempt in range(ATTEMPTS):
+        try:
+            result = f(*args)
+            if not result:
+                db.session.rollback()
+                return result
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt == ATTEMPTS - 1 or not deadlock(e):
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+def changed(model, id, statement):
+    # UPDATE condizionale: True solo se la riga rispettava il vincolo al momento della scrittura
+    if db.session.execute(statement, execution_options={'synchronize_session': False}).rowcount != 1:
+        return False
+    touch(db.session, model, id)
+    return True
+
+def take_copy(book_id):
+    # Il flag si aggiorna con un secondo UPDATE: MySQL valuta il SET da sinistra a destra,
+    # quindi un CASE su copie nello stesso UPDATE vedrebbe già il valore decrementato
+    if not changed(counters(Libro), book_id, update(Libro).where(Libro.id == book_id, Libro.copie > 0).values(copie=Libro.copie - 1)):
+        return False
+    db.session.execute(update(Libro).where(Libro.id == book_id, Libro.copie == 0).values(disponibile=False),
+        execution_options={'synchronize_session': False})
+    return True
+
+def return_copy(book_id):
+    return changed(counters(Libro), book_id, update(Libro).where(Libro.id == book_id).values(copie=Libro.copie + 1, disponibile=True))
+
+def close_loan(loan, today=None):
+    # Solo il primo che chiude il prestito restituisce la copia
+    values = {'terminato': True, 'restituito': True}
+    if today:
+        values['rientro'] = today
+    if not changed(Prestito, loan.id, update(Prestito).where(Prestito.id == loan.id, Prestito.terminato == "No").values(values)):
+        return False
+    touch_day(db.session, loan.uscita)
+    return True
+
+def reserve_seat(course_id):
+    # Le prenotazioni in attesa occupano un posto fino alla conferma o al rifiuto
+    return changed(counters(Corso), course_id, update(Corso)
+        .where(Corso.id == course_id, Corso.iscrizioni + Corso.prenotazioni < Corso.massimo)
+        .values(prenotazioni=Corso.prenotazioni + 1))
+
+def confirm_seat(course_id):
+    return changed(counters(Corso), course_id, update(Corso).where(Corso.id == course_id, Corso.prenotazioni > 0)
+        .values(prenotazioni=Corso.prenotazioni - 1, iscrizioni=Corso.iscrizioni + 1))
+
+def release_seat(course_id):
+    return changed(counters(Corso), course_id, update(Corso).where(Corso.id == course_id, Corso.prenotazioni > 0)
+        .values(prenotazioni=Corso.prenotazioni - 1))
+
+def set_state(booking_id, state):
+    return changed(Booking, booking_id, update(Booking).where(Booking.id == booking_id, Booking.state == "Pending")
+        .values(state=state))
+
+# Operazioni complete: ognuna è una sola transazione, ripetuta in caso di deadlock
+
+def lend(book_id, user_id, uscita, rientro):
+    def run():
+        if not take_copy(book_id):
+            return None
+        loan = Prestito(uscita=uscita, rientro=rientro, terminato='No', restituito="No", prorogato='No', libro_id=book_id, utente_id=user_id)
+        db.session.add(loan)
+        return loan
+    return transaction(run)
+
+def terminate(loan_id, today):
+    def run():
+        loan = db.session.get(Prestito, loan_id)
+        if not loan or not close_loan(loan, today):
+            return False
+        return return_copy(loan.libro_id)
+    return transaction(run)
+
+def remove(loan_id):
+    def run():
+        loan = db.session.get(Prestito, loan_id)
+        if not loan:
+            return False
+        if close_loan(loan):
+            return_copy(loan.libro_id)
+        db.session.delete(loan)
+        return True
+    return transaction(run)
+
+def reserve(course_id, user_id, today):
+    def run():
+        if not reserve_seat(course_id):
+            return None
+        booking = Booking(state="Pending", bdate=today, corso_id=course_id, utente_id=user_id)
+        db.session.add(booking)
+        return booking
+    return transaction(run)
+
+def confirm(booking_id, course_id):
+    def run():
+        return set_state(booking_id, "Confirmed") and confirm_seat(course_id)
+    return transaction(run)
+
+def reject(booking_id, course_id):
+    def run():
+        return set_state(booking_id, "Rejected") and release_seat(course_id)
+    return transaction(run)
+
+# Operazioni a blocchi per il banco prestiti: una transazione, un UPDATE per tabella
+
+BATCH = 500
+EXTENSION = 15
+
+def shift(column, days):
+    # column + days giorni, nel dialetto del database in uso
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return func.date(column, f'+{days} days')
+    if dialect == 'postgresql':
+        return column + days
+    return func.date_add(column, text(f'INTERVAL {days} DAY'))
+
+def resolve(loan_ids, book_ids):
+    # Abbina ogni voce a un prestito: per i libri scansionati, il prestito aperto più vecchio non ancora usato
+    columns = (Prestito.id, Prestito.libro_id, Prestito.uscita, Prestito.terminato, Prestito.prorogato)
+    items, seen = [], set()
+    if loan_ids:
+        rows = {row.id: row for row in db.session.query(*columns).filter(Prestito.id.in_(loan_ids)).with_for_update()}
+        for id in loan_ids:
+            items.append({'loan': id, 'row': None if id in seen else rows.get(id), 'result': 'duplicate' if id in seen else 'not_found'})
+            seen.add(id)
+    if book_ids:
+        open_loans = {}
+        for row in db.session.query(*columns).filter(Prestito.libro_id.in_(book_ids), Prestito.terminato == "No") \
+                .order_by(Prestito.rientro, Prestito.id).with_for_update():
+            open_loans.setdefault(row.libro_id, []).append(row)
+        for id in book_ids:
+            row = open_loans.get(id, []).pop(0) if open_loans.get(id) else None
+            items.append({'book': id, 'loan': row.id if row else None, 'row': row, 'result': 'not_found'})
+    return items
+
+def return_copies(loans):
+    # Un solo UPDATE per tutti i libri: copie = copie + n, con n diverso per libro
+    counts = {}
+    for row in loans:
+        counts[row.libro_id] = counts.get(row.libro_id, 0) + 1
+    if not counts:
+        return
+    db.session.execute(update(Libro).where(Libro.id.in_(counts))
+        .values(copie=Libro.copie + case(counts, value=Libro.id, else_=0), disponibile=True),
+        execution_options={'synchronize_session': False})
+    for id in counts:
+        touch(db.session, counters(Libro), id)
+
+def claim(rows, values, *conditions):
+    # UPDATE con il vincolo nella WHERE, come close_loan: restituisce le sole righe davvero cambiate.
+    # Su SQLite FOR UPDATE non ha effetto e due blocchi sovrapposti possono aver letto gli stessi prestiti aperti
+    rows = list({row.id: row for row in rows}.values())
+    if not rows:
+        return []
+    statement = update(Prestito).where(Prestito.id.in_([row.id for row in rows]), *conditions).values(values)
+    options = {'synchronize_session': False}
+    if db.engine.dialect.update_returning:
+        return db.session.execute(statement.returning(Prestito.id, Prestito.libro_id, Prestito.uscita), execution_options=options).all()
+    # MySQL non ha UPDATE ... RETURNING, ma lì le righe lette in resolve restano bloccate fino al commit
+    db.session.execute(statement, execution_options=options)
+    return rows
+
+def batch(action, loan_ids=(), book_ids=(), today=None):
+    def run():
+        items = resolve(loan_ids, book_ids)
+        done = []
+        for item in items:
+            row = item.pop('row')
+            if not row:
+                continue
+            if action in ('term', 'extend') and row.terminato == "Si":
+                item['result'] = 'terminated'
+            elif action == 'extend' and row.prorogato == "Si":
+                item['result'] = 'extended'
+            else:
+                item['result'] = 'ok'
+                done.append(row)
+
+        if action == 'term':
+            changed = claim(done, {'terminato': True, 'restituito': True, 'rientro': today or date.today()}, Prestito.terminato == "No")
+            return_copies(changed)
+        elif action == 'extend':
+            changed = claim(done, {'rientro': shift(Prestito.rientro, EXTENSION), 'prorogato': True},
+                Prestito.terminato == "No", Prestito.prorogato == "No")
+        else:
+            # Si chiudono prima i prestiti aperti, così la copia torna una volta sola anche con un termine in corso
+            return_copies(claim([row for row in done if row.terminato == "No"], {'terminato': True, 'restituito': True}, Prestito.terminato == "No"))
+            if done:
+                db.session.execute(delete(Prestito).where(Prestito.id.in_([row.id for row in done])), execution_options={'synchronize_session': False})
+            changed = done
+
+        # Le voci non aggiornate sono state chiuse o prorogate da un'altra richiesta, o ripetono un prestito già nel blocco
+        ids, seen = {row.id for row in changed}, set()
+        for item in items:
+            if item['result'] != 'ok':
+                continue
+            if item['loan'] in seen:
+                item['result'] = 'duplicate'
+            elif item['loan'] not in ids:
+                item['result'] = 'terminated' if action != 'extend' else 'extended'
+            seen.add(item['loan'])
+        for row in changed:
+            touch(db.session, Prestito, row.id)
+            touch_day(db.session, row.uscita)
+        return items
+    return transaction(run)
@@ -0,0 +1,130 @@
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+from functools import lru_cache
+import bisect, re, threading, time
+
+@lru_cache(maxsize=2048)
+def shape(statement):
+    # Forma dell'istruzione: letterali e liste IN ridotti a "?", così le query nei cicli coincidono
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'\b\d+(?:\.\d+)?\b', '?', statement)
+    statement = re.sub(r'%\(\w+\)s|%s|:\w+|\$\d+', '?', statement)
+    statement = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', statement)
+    return ' '.join(statement.split())
+
+class Histogram:
+    # Istogramma cumulativo nel formato di Prometheus
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        total = 0
+        for le, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, le, total)
+        yield '%s_sum{%s} %s' % (name, labels, round(self.sum, 6))
+        yield '%s_count{%s} %d' % (name, labels, total)
+
+def summary(statement):
+    # Per etichette e log: l'elenco delle colonne non serve a riconoscere la query
+    return re.sub(r'^SELECT .+? FROM ', 'SELECT ... FROM ', statement)[:200]
+
+def label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+class Metrics:
+    # Query SQL di ogni richiesta (numero, tempo sul database, istruzioni ripetute) aggregate per endpoint.
+    # I valori sono del singolo processo: con più worker Prometheus li somma per istanza
+    histograms = {
+        'request_duration_seconds': ('Durata delle richieste', (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+        'sql_queries': ('Query SQL per richiesta', (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)),
+        'sql_duration_seconds': ('Tempo speso sul database per richiesta', (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+        'sql_duplicates': ('Query ripetute con la stessa forma per richiesta', (0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.threshold = 10
+        self.enabled = True
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SQL_METRICS', self.enabled)
+        self.threshold = app.config.get('SQL_REPEAT_THRESHOLD', self.threshold)
+        if not self.enabled:
+            return
+        app.before_request(self.begin)
+        app.teardown_request(self.end)
+        if not event.contains(Engine, 'before_cursor_execute', self.before):
+            event.listen(Engine, 'before_cursor_execute', self.before)
+            event.listen(Engine, 'after_cursor_execute', self.after)
+
+    def begin(self):
+        g.sql = {'start': time.perf_counter(), 'count': 0, 'time': 0.0, 'shapes': Counter()}
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql' in g:
+            conn.info.setdefault('sql_start', []).append(time.perf_counter())
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context() or 'sql' not in g or not conn.info.get('sql_start'):
+            return
+        sql = g.sql
+        sql['time'] += time.perf_counter() - conn.info['sql_start'].pop()
+        sql['count'] += 1
+        sql['shapes'][shape(statement)] += 1
+
+    def end(self, exc=None):
+        sql = g.pop('sql', None)
+        if sql is None:
+            return
+        endpoint = request.endpoint or 'unknown'
+        duplicates = sql['count'] - len(sql['shapes'])
+        repeated = [(statement, n) for statement, n in sql['shapes'].items() if n > self.threshold]
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'histograms': {name: Histogram(buckets) for name, (_, buckets) in self.histograms.items()},
+                    'repeated': {}
+                }
+            histograms = stats['histograms']
+            histograms['request_duration_seconds'].observe(time.perf_counter() - sql['start'])
+            histograms['sql_queries'].observe(sql['count'])
+            histograms['sql_duration_seconds'].observe(sql['time'])
+            histograms['sql_duplicates'].observe(duplicates)
+            for statement, n in repeated:
+                seen = stats['repeated'].setdefault(statement, [0, 0])
+                seen[0] += 1
+                seen[1] = max(seen[1], n)
+        for statement, n in repeated:
+            current_app.logger.warning("Possibile N+1 in %s (%s): %d esecuzioni di %s",
+                endpoint, request.path, n, summary(statement))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            for name, (help, _) in self.histograms.items():
+                lines.append('# HELP library_%s %s' % (name, help))
+                lines.append('# TYPE library_%s histogram' % name)
+                for endpoint, stats in endpoints:
+                    lines.extend(stats['histograms'][name].lines('library_' + name, 'endpoint="%s"' % label(endpoint)))
+            for name, index, help, kind in (('sql_repeated_requests_total', 0, "Richieste in cui un'istruzione supera la soglia di ripetizioni", 'counter'),
+                                            ('sql_repeated_max', 1, 'Massimo di ripetizioni della stessa istruzione in una richiesta', 'gauge')):
+                lines.append('# HELP library_%s %s' % (name, help))
+                lines.append('# TYPE library_%s %s' % (name, kind))
+                for endpoint, stats in endpoints:
+                    for statement, seen in sorted(stats['repeated'].items()):
+                        lines.append('library_%s{endpoint="%s",statement="%s"} %d' % (name, label(endpoint), label(summary(statement)), seen[index]))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
@@ -1,12 +1,31 @@
 from flask_login import UserMixin
 from . import db
 
+class SiNo(db.TypeDecorator):
+    # Booleano nel database, "Si"/"No" per route e template
+    impl = db.Boolean
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bool):
+            return value
+        return value in ("Si", "Sì", "1", 1)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return "Si" if value else "No"
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     titolo = db.Column(db.String(100), nullable=False)
     corpo = db.Column(db.Text, nullable=False)
     msgdate = db.Column(db.DateTime, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_message_msgdate', 'msgdate'),
+    )
+
 class Utente(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100))
@@ -19,7 +38,7 @@ class Utente(UserMixin, db.Model):
 class Libro(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     titolo = db.Column(db.String(255), nullable=False)
-    anno = db.Column(db.String(255), nullable=False)
+    anno = db.Column(db.SmallInteger)
     classificazione = db.Column(db.String(255), nullable=False)
     posizione = db.Column(db.String(255), nullable=False)
     autore = db.Column(db.String(255), nullable=False)
@@ -28,12 +47,20 @@ class Libro(db.Model):
     editore = db.Column(db.String(255), nullable=False)
     note = db.Column(db.Text)
     copie = db.Column(db.Integer, nullable=False)
-    disponibile = db.Column(db.String(255), nullable=False)
-    libro_mese = db.Column(db.String(255), nullable=False)
-    rivista = db.Column(db.String(255), nullable=False)
+    disponibile = db.Column(SiNo, nullable=False)
+    libro_mese = db.Column(SiNo, nullable=False)
+    rivista = db.Column(SiNo, nullable=False)
     viste = db.Column(db.Integer, nullable=False)
     download = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_libro_genere_titolo', 'genere', 'titolo'),
+        db.Index('ix_libro_titolo_autore', 'titolo', 'autore'),
+        db.Index('ix_libro_autore', 'autore'),
+        db.Index('ix_libro_libro_mese', 'libro_mese'),
+        db.Index('ix_libro_viste', 'viste'),
+    )
+
 class Corso(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(255), nullable=False, unique=True)
@@ -55,15 +82,36 @@ class Prestito(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     uscita = db.Column(db.Date, nullable=False)
     rientro = db.Column(db.Date, nullable=False)
-    terminato = db.Column(db.String(2), nullable=False)
-    restituito = db.Column(db.String(2), nullable=False)
-    prorogato = db.Column(db.String(2), nullable=False)
+    terminato = db.Column(SiNo, nullable=False)
+    restituito = db.Column(SiNo, nullable=False)
+    prorogato = db.Column(SiNo, nullable=False)
     libro_id = db.Column(db.BigInteger, db.ForeignKey('libro.id'), nullable=False)
     utente_id = db.Column(db.BigInteger, db.ForeignKey('utente.id'), nullable=False)
 
     libro = db.relationship('Libro', backref=db.backref('prestiti', lazy=True))
     utente = db.relationship('Utente', backref=db.backref('prestiti', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_prestito_libro_terminato_rientro', 'libro_id', 'terminato', 'rientro'),
+        db.Index('ix_prestito_libro_uscita', 'libro_id', 'uscita'),
+        db.Index('ix_prestito_utente_terminato', 'utente_id', 'terminato'),
+        db.Index('ix_prestito_restituito_rientro', 'restituito', 'rientro'),
+        db.Index('ix_prestito_rientro', 'rientro'),
+        db.Index('ix_prestito_uscita', 'uscita'),
+    )
+
+class PrestitoGiornaliero(db.Model):
+    # Riepilogo dei prestiti per data di uscita, tenuto da analytics.py
+    giorno = db.Column(db.Date, primary_key=True)
+    prestiti = db.Column(db.Integer, nullable=False)
+    giorni = db.Column(db.Integer, nullable=False)
+    insoliti = db.Column(db.Integer, nullable=False)
+
+class GiornoModificato(db.Model):
+    # Giorni del riepilogo da ricalcolare, scritti nella stessa transazione della modifica al prestito
+    id = db.Column(db.Integer, primary_key=True)
+    giorno = db.Column(db.Date, nullable=False)
+
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     state = db.Column(db.String(255), nullable=False)
@@ -73,6 +121,12 @@ class Booking(db.Model):
 
     corso = db.relationship('Corso', backref=db.backref('booking_course', lazy=True))
     utente = db.relationship('Utente', backref=db.backref('booking_user', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_booking_corso_state', 'corso_id', 'state'),
+        db.Index('ix_booking_state', 'state'),
+        db.Index('ix_booking_utente', 'utente_id'),
+    )
     
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -84,6 +138,10 @@ class Review(db.Model):
     libro = db.relationship('Libro', backref=db.backref('reviews', lazy=True))
     utente = db.relationship('Utente', backref=db.backref('reviews', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_review_libro_rating', 'libro_id', 'rating'),
+    )
+
 class Ratings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Integer, nullable=False)
@@ -92,4 +150,16 @@ class Ratings(db.Model):
     corso_id = db.Column(db.Integer, db.ForeignKey('corso.id'), nullable=False)
 
     utente = db.relationship('Utente', backref=db.backref('ratings', lazy=True))
-    corso = db.relationship('Corso', backref=db.backref('ratings', lazy=True))
\ No newline at end of file
+    corso = db.relationship('Corso', backref=db.backref('ratings', lazy=True))
+
+    __table_args__ = (
+        db.Index('ix_ratings_corso', 'corso_id'),
+    )
+
+# Conteggi per utente calcolati dal database con una subquery correlata (caricati solo con undefer)
+Utente.loan_count = db.column_property(
+    db.select(db.func.count(Prestito.id)).where(Prestito.utente_id == Utente.id).correlate_except(Prestito).scalar_subquery(),
+    deferred=True)
+Utente.booking_count = db.column_property(
+    db.select(db.func.count(Booking.id)).where(Booking.utente_id == Utente.id).correlate_except(Booking).scalar_subquery(),
+    deferred=True)
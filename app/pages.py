@@ -0,0 +1,78 @@
+from flask import Response, request, session
+from flask_login import current_user
+from datetime import datetime, timezone
+from functools import wraps
+from .models import Libro, Corso
+from .events import on_commit
+from .utils import TTLCache, Stamp
+from .stats import dashboard
+import os, tempfile
+
+class PageCache:
+    # Pagine pubbliche già renderizzate per i visitatori anonimi, valide finché non cambia il catalogo
+    def __init__(self):
+        self.store = TTLCache(3600, 256)
+        self.stamp = Stamp(os.path.join(tempfile.gettempdir(), 'library-catalog.stamp'))
+        self.seen = None
+
+    def init_app(self, app):
+        self.store.ttl = app.config.get('PAGE_CACHE_TTL', self.store.ttl)
+        self.store.size = app.config.get('PAGE_CACHE_SIZE', self.store.size)
+        self.stamp.path = app.config.get('PAGE_CACHE_STAMP', self.stamp.path)
+        if not self.stamp.version():
+            self.stamp.touch()
+
+    def version(self):
+        # Il file di versione è condiviso: una scrittura in un processo invalida le pagine di tutti
+        version = self.stamp.version()
+        if version != self.seen:
+            self.store.clear()
+            # Le pagine si rigenerano dalle statistiche: non devono finire sotto il nuovo ETag con aggregati di prima
+            dashboard.drop('books', 'month', 'courses')
+            self.seen = version
+        return version
+
+    def invalidate(self):
+        self.stamp.touch()
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Utenti autenticati e messaggi flash in sospeso vedono sempre la pagina viva
+            if request.method != 'GET' or current_user.is_authenticated or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            version = self.version()
+            etag = format(version, 'x')
+            modified = datetime.fromtimestamp(version / 1e9, timezone.utc).replace(microsecond=0)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                # Il rendering avviene fuori da ogni lock; TTLCache lo prende solo per salvare il risultato
+                entry = self.store.get(request.full_path, lambda: self.render(view, args, kwargs))
+                if entry is None:
+                    return view(*args, **kwargs)
+                response = Response(entry[0], mimetype=entry[1])
+            response.set_etag(etag, weak=True)
+            response.last_modified = modified
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response.make_conditional(request)
+        return wrapper
+
+    def render(self, view, args, kwargs):
+        # Si conservano solo le risposte 200 complete; None se la pagina non è cacheable
+        response = view(*args, **kwargs)
+        if not isinstance(response, Response):
+            response = Response(response)
+        if response.status_code != 200 or response.is_streamed:
+            return None
+        return response.get_data(), response.mimetype
+
+pages = PageCache()
+
+# Solo le modifiche al catalogo: prestiti e prenotazioni toccano counters(Libro/Corso), che le pagine anonime non mostrano
+@on_commit(Libro, Corso)
+def catalog_changed(changes):
+    pages.invalidate()
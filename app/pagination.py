@@ -0,0 +1,77 @@
+from flask import request, url_for
+from sqlalchemy import and_, or_
+import base64, datetime, json
+
+DEFAULT_SIZE = 25
+MAX_SIZE = 100
+
+def encode(values):
+    values = [v.isoformat() if isinstance(v, (datetime.date, datetime.datetime)) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode(token, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != len(columns):
+        return None
+    for i, (column, desc) in enumerate(columns):
+        kind = column.type.python_type
+        if values[i] is not None and kind in (datetime.date, datetime.datetime):
+            try:
+                values[i] = kind.fromisoformat(values[i])
+            except (TypeError, ValueError):
+                return None
+    return values
+
+def seek(columns, values, forward):
+    # (a, b, id) > (x, y, z) scritto per esteso, così funziona anche con direzioni miste
+    clauses = []
+    for i, (column, desc) in enumerate(columns):
+        equal = [c == v for (c, d), v in zip(columns[:i], values[:i])]
+        after = column < values[i] if desc == forward else column > values[i]
+        clauses.append(and_(*equal, after))
+    return or_(*clauses)
+
+class Page:
+    def __init__(self, items, size, sort, next=None, prev=None):
+        self.items = items
+        self.size = size
+        self.sort = sort
+        self.next = next
+        self.prev = prev
+
+    def url(self, **args):
+        return url_for(request.endpoint, **(request.view_args or {}), size=self.size, sort=self.sort, **args)
+
+def paginate(query, sorts, default=None):
+    # sorts: {nome: [(colonna, desc), ...]}; l'ultima colonna deve essere univoca (di solito l'id)
+    sort = request.args.get('sort', default)
+    if sort not in sorts:
+        sort = default or next(iter(sorts))
+    columns = sorts[sort]
+    size = max(1, min(request.args.get('size', DEFAULT_SIZE, type=int), MAX_SIZE))
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    cursor = decode(before or after, columns) if (before or after) else None
+    forward = not (before and cursor)
+    if cursor:
+        query = query.filter(seek(columns, cursor, forward))
+    order = [column.desc() if desc == forward else column.asc() for column, desc in columns]
+    rows = query.order_by(*order).limit(size + 1).all()
+
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+
+    key = lambda row: encode([getattr(row, column.key) for column, desc in columns])
+    page = Page(rows, size, sort)
+    if rows:
+        if more or not forward:
+            page.next = key(rows[-1])
+        if (forward and cursor) or (not forward and more):
+            page.prev = key(rows[0])
+    return page
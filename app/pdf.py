@@ -0,0 +1,276 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import atexit, hashlib, json, os, re, shutil, signal, tempfile, threading, time, uuid
+
+def expired(signum, frame):
+    raise TimeoutError("Tempo massimo per la generazione del PDF superato.")
+
+def render(source, path, copy=None, timeout=None):
+    # Eseguita in un processo del pool: scrive prima su .part e poi rinomina.
+    # timeout: SIGALRM interrompe pisa nel thread principale del processo (non su Windows)
+    from xhtml2pdf import pisa
+    part = path + '.part'
+    alarm = timeout and hasattr(signal, 'setitimer')
+    try:
+        with open(part, 'wb') as dest:
+            if alarm:
+                signal.signal(signal.SIGALRM, expired)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                status = pisa.CreatePDF(source, dest=dest)
+            finally:
+                if alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        if status.err:
+            raise RuntimeError("Errore durante la creazione del PDF: %s" % status.err)
+        if copy:
+            shutil.copyfile(part, copy + '.part')
+            os.replace(copy + '.part', copy)
+        os.replace(part, path)
+    except Exception as e:
+        with open(path[:-4] + '.err', 'w') as f:
+            f.write(str(e))
+        if os.path.exists(part):
+            os.remove(part)
+
+class PdfJobs:
+    # Coda dei PDF: lo stato di ogni job vive su disco, così è visibile da tutti i processi
+    def __init__(self):
+        # Rientrante: i callback dei job già conclusi girano subito, nel thread che tiene il lock
+        self.lock = threading.RLock()
+        self.pool = None
+        self.threads = None
+        self.app = None
+        # ID del job -> (future, pool); pool None mentre si prepara l'HTML
+        self.pending = {}
+        self.directory = os.path.join(tempfile.gettempdir(), 'library-pdf')
+        self.workers = os.cpu_count() or 1
+        self.queue = self.workers * 8
+        self.ttl = 900
+        self.timeout = 300
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config.get('PDF_DIR', self.directory)
+        self.workers = app.config.get('PDF_WORKERS') or self.workers
+        self.queue = app.config.get('PDF_QUEUE', self.workers * 8)
+        self.ttl = app.config.get('PDF_TTL', self.ttl)
+        self.timeout = app.config.get('PDF_TIMEOUT', self.timeout)
+        os.makedirs(self.directory, exist_ok=True)
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        if self.threads:
+            self.threads.shutdown(wait=False, cancel_futures=True)
+            self.threads = None
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def path(self, id, ext):
+        return os.path.join(self.directory, id + ext)
+
+    def submit(self, source, name, owner, copy=None, inline=False):
+        # Restituisce l'ID del job, oppure None se la coda è piena.
+        # source è l'HTML o una funzione che lo produce: query e template girano allora in un thread, fuori dalla richiesta.
+        # inline: il PDF si genera nel processo della richiesta, per profilarlo
+        self.cleanup()
+        cache.evict()
+        if inline:
+            id = uuid.uuid4().hex
+            with open(self.path(id, '.json'), 'w') as f:
+                json.dump({'name': name, 'owner': owner}, f)
+            render(source() if callable(source) else source, self.path(id, '.pdf'), copy)
+            return id
+        with self.lock:
+            self.pending = {id: job for id, job in self.pending.items() if not job[0].done()}
+            if len(self.pending) >= self.queue:
+                return None
+
+            id = uuid.uuid4().hex
+            with open(self.path(id, '.json'), 'w') as f:
+                json.dump({'name': name, 'owner': owner}, f)
+            if callable(source):
+                if not self.threads:
+                    self.threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pdf')
+                future = self.threads.submit(self.prepare, id, source, copy)
+                future.add_done_callback(partial(self.finished, id, None))
+                self.pending[id] = (future, None)
+            else:
+                self.dispatch(id, source, copy)
+        return id
+
+    def prepare(self, id, source, copy):
+        with self.app.app_context():
+            html = source()
+        with self.lock:
+            self.dispatch(id, html, copy)
+
+    def dispatch(self, id, html, copy):
+        pool = self.start()
+        try:
+            future = pool.submit(render, html, self.path(id, '.pdf'), copy, self.timeout)
+        except BrokenProcessPool:
+            # Il pool si è rotto dopo l'ultimo job: se ne crea uno nuovo e si riprova una volta
+            self.discard(pool)
+            pool = self.start()
+            future = pool.submit(render, html, self.path(id, '.pdf'), copy, self.timeout)
+        future.add_done_callback(partial(self.finished, id, pool))
+        self.pending[id] = (future, pool)
+
+    def start(self):
+        if not self.pool:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            if self.timeout:
+                threading.Thread(target=self.watch, args=(self.pool,), name='pdf-watch', daemon=True).start()
+        return self.pool
+
+    def watch(self, pool):
+        # Se un job resta in esecuzione oltre il doppio del timeout nemmeno SIGALRM lo ha fermato
+        # (codice C bloccato, o Windows): si uccidono i processi del pool, i job in corso finiscono con un .err.
+        # Il doppio perché il pool segna come avviato anche il job che aspetta nella sua coda interna
+        started = {}
+        while self.pool is pool:
+            time.sleep(min(self.timeout, 5))
+            now = time.monotonic()
+            with self.lock:
+                running = [future for future, owner in self.pending.values() if owner is pool and future.running()]
+            started = {future: started.get(future, now) for future in running}
+            if any(now - since > self.timeout * 2 for since in started.values()):
+                for process in list((getattr(pool, '_processes', None) or {}).values()):
+                    process.kill()
+                return
+
+    def discard(self, pool):
+        # Un pool rotto non accetta altri job: il prossimo submit ne crea uno nuovo
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def finished(self, id, pool, future):
+        # render() scrive da sé il .err; qui arrivano i job persi con il processo (es. ucciso per memoria)
+        # e quelli in cui la preparazione dell'HTML (pool None) è fallita
+        if future.cancelled():
+            error = "Generazione del PDF annullata."
+        elif future.exception() is not None and pool is None:
+            error = "Preparazione del PDF non riuscita: %s" % future.exception()
+        elif future.exception() is not None:
+            error = "Il processo che generava il PDF si è interrotto: %s" % future.exception()
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.discard(pool)
+        else:
+            return
+        if not os.path.exists(self.path(id, '.pdf')) and not os.path.exists(self.path(id, '.err')):
+            with open(self.path(id, '.err'), 'w') as f:
+                f.write(error)
+
+    def job(self, id):
+        if not id.isalnum() or not os.path.exists(self.path(id, '.json')):
+            return None
+        with open(self.path(id, '.json')) as f:
+            job = json.load(f)
+        if os.path.exists(self.path(id, '.pdf')):
+            job['status'] = 'done'
+        elif os.path.exists(self.path(id, '.err')):
+            job['status'] = 'failed'
+        else:
+            job['status'] = 'pending'
+        return job
+
+    def cleanup(self):
+        # Elimina i file più vecchi del TTL, compresi quelli lasciati da convert(). Il .json di un job se ne va
+        # con il suo .pdf o .err; senza risultato il job può essere ancora in coda, qui o in un altro processo,
+        # e si elimina solo quando nemmeno una coda piena di job al timeout lo avrebbe completato
+        now = time.time()
+        try:
+            entries = {entry.name: entry for entry in os.scandir(self.directory)}
+        except FileNotFoundError:
+            return
+        with self.lock:
+            active = {id for id, job in self.pending.items() if not job[0].done()}
+        waiting = self.ttl + self.timeout * (self.queue // self.workers + 1)
+        for name, entry in entries.items():
+            id, _, ext = name.partition('.')
+            if id in active:
+                continue
+            if ext == 'json' and (id + '.pdf' in entries or id + '.err' in entries):
+                continue
+            try:
+                if now - entry.stat().st_mtime > (waiting if ext == 'json' else self.ttl):
+                    os.remove(entry.path)
+                    if ext in ('pdf', 'err'):
+                        os.remove(self.path(id, '.json'))
+            except FileNotFoundError:
+                pass
+
+class PdfCache:
+    # Cache su disco indicizzata dall'hash dell'HTML; il tag raggruppa i file da invalidare insieme
+    def __init__(self):
+        self.directory = os.path.join(tempfile.gettempdir(), 'library-pdf-cache')
+        self.size = 200 * 1024 * 1024
+
+    def init_app(self, app):
+        self.directory = app.config.get('PDF_CACHE_DIR', self.directory)
+        self.size = app.config.get('PDF_CACHE_SIZE', self.size)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def tag(self, tag):
+        return re.sub(r'[^\w-]', '_', tag)[:64] + '--'
+
+    def path(self, tag, source):
+        key = hashlib.sha256(source.encode()).hexdigest()
+        return os.path.join(self.directory, self.tag(tag) + key + '.pdf')
+
+    def get(self, tag, source):
+        path = self.path(tag, source)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, tag, source, pdf):
+        path = self.path(tag, source)
+        shutil.move(pdf, path)
+        self.evict()
+        return path
+
+    def invalidate(self, *tags):
+        prefixes = tuple(self.tag(tag) for tag in tags)
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(prefixes):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        # LRU: get() aggiorna l'mtime, quindi si eliminano i file usati meno di recente
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+jobs = PdfJobs()
+cache = PdfCache()
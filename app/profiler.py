@@ -0,0 +1,126 @@
+from flask import g, request, url_for
+from flask_login import current_user
+from collections import Counter
+from datetime import datetime
+import os, re, sys, tempfile, threading, time
+
+# Radice del flame graph per ogni campione: il primo modulo riconosciuto risalendo dalla foglia
+CATEGORIES = (
+    ('sql', ('sqlalchemy', 'sqlite3', 'MySQLdb', 'pymysql', 'psycopg')),
+    ('jinja', ('jinja2', 'templates')),
+    ('xhtml2pdf', ('xhtml2pdf', 'reportlab', 'html5lib'))
+)
+
+def category(filenames):
+    for filename in filenames:
+        parts = re.split(r'[\\/]', filename)
+        for name, packages in CATEGORIES:
+            if any(package in parts for package in packages):
+                return name
+    return 'python'
+
+class Sampler(threading.Thread):
+    # Campiona lo stack del thread della richiesta; ogni stack pesa il tempo trascorso dal campione precedente
+    def __init__(self, ident, interval):
+        super().__init__(name='profiler', daemon=True)
+        self.target = ident
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            now = time.perf_counter()
+            if frame is not None:
+                self.stacks[self.collapse(frame)] += now - last
+            last = now
+
+    def collapse(self, frame):
+        frames, filenames = [], []
+        while frame is not None:
+            code = frame.f_code
+            frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            filenames.append(code.co_filename)
+            frame = frame.f_back
+        return ';'.join([category(filenames)] + frames[::-1])
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+class Profiler:
+    # Profilo di una singola richiesta, su richiesta di un manager con l'header X-Profile o ?profile=1.
+    # Con PROFILING spento non registra nessun hook
+    def __init__(self):
+        self.directory = os.path.join(tempfile.gettempdir(), 'library-profiles')
+        self.interval = 0.001
+        self.keep = 100
+
+    def init_app(self, app):
+        if not app.config.get('PROFILING'):
+            return
+        self.directory = app.config.get('PROFILE_DIR', self.directory)
+        self.interval = app.config.get('PROFILE_INTERVAL', self.interval)
+        self.keep = app.config.get('PROFILE_KEEP', self.keep)
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self.begin)
+        app.after_request(self.headers)
+        app.teardown_request(self.end)
+
+    def active(self):
+        return 'profile' in g
+
+    def begin(self):
+        if not (request.headers.get('X-Profile') or request.args.get('profile')):
+            return
+        if not current_user.is_authenticated or current_user.ruolo != "Manager":
+            return
+        name = '%s-%s.folded' % (datetime.now().strftime('%Y%m%d-%H%M%S-%f'), re.sub(r'[^\w-]', '_', request.endpoint or 'unknown'))
+        g.profile = {'name': name, 'start': time.perf_counter(), 'sampler': Sampler(threading.get_ident(), self.interval)}
+        g.profile['sampler'].start()
+
+    def headers(self, response):
+        profile = g.get('profile')
+        if profile:
+            response.headers['X-Profile'] = url_for('main.mprofile', name=profile['name'])
+            # Le risposte in streaming finiscono dopo: i tempi sono solo nel file del profilo
+            if not response.is_streamed:
+                timing = self.timing(profile)
+                response.headers['Server-Timing'] = ', '.join('%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in timing.items())
+        return response
+
+    def timing(self, profile):
+        timing = Counter()
+        for stack, seconds in list(profile['sampler'].stacks.items()):
+            timing[stack.split(';', 1)[0]] += seconds
+        timing['total'] = time.perf_counter() - profile['start']
+        return timing
+
+    def end(self, exc=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile['sampler'].stop()
+        # Formato "collapsed" di flamegraph.pl e speedscope: stack separati da ';' e peso in microsecondi
+        with open(self.path(profile['name']), 'w') as f:
+            for stack, seconds in profile['sampler'].stacks.most_common():
+                f.write('%s %d\n' % (stack, round(seconds * 1e6)))
+        self.cleanup()
+
+    def path(self, name):
+        if not re.fullmatch(r'[\w-]+\.folded', name):
+            return None
+        return os.path.join(self.directory, name)
+
+    def cleanup(self):
+        # Si tengono solo gli ultimi PROFILE_KEEP profili
+        entries = sorted(os.scandir(self.directory), key=lambda entry: entry.name, reverse=True)
+        for entry in entries[self.keep:]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+profiler = Profiler()
@@ -0,0 +1,111 @@
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from contextlib import contextmanager
+from functools import wraps
+import threading, time
+
+class RoutingSession(Session):
+    # Nelle route in sola lettura le SELECT vanno sulla replica; flush e scritture restano sul primario
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False) and replicas.active():
+            return self._db.engines[replicas.key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class Replicas:
+    def __init__(self, key='replica'):
+        self.key = key
+        self.lock = threading.Lock()
+        self.interval = 5
+        self.max_lag = 10
+        self.checked = 0
+        self.healthy = False
+
+    def init_app(self, app):
+        self.interval = app.config.get('REPLICA_CHECK', self.interval)
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', self.max_lag)
+
+    def configured(self):
+        return self.key in current_app.config.get('SQLALCHEMY_BINDS', {})
+
+    def active(self):
+        return has_app_context() and g.get('replica', False)
+
+    def lag(self, connection):
+        # Secondi di ritardo della replica; 0 se il database non è una replica (es. due SQLite in locale)
+        dialect = connection.dialect.name
+        if dialect == 'postgresql':
+            return connection.execute(text("SELECT CASE WHEN pg_is_in_recovery() "
+                "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END")).scalar()
+        if dialect in ('mysql', 'mariadb'):
+            try:
+                row = connection.execute(text('SHOW REPLICA STATUS')).mappings().first()
+            except SQLAlchemyError:
+                row = connection.execute(text('SHOW SLAVE STATUS')).mappings().first()
+            if not row:
+                return 0
+            lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+            # NULL: la replica non sta applicando le modifiche
+            return float('inf') if lag is None else lag
+        connection.execute(text('SELECT 1'))
+        return 0
+
+    def check(self):
+        # Controllo della replica al più ogni REPLICA_CHECK secondi per processo
+        if time.monotonic() - self.checked < self.interval:
+            return self.healthy
+        with self.lock:
+            if time.monotonic() - self.checked < self.interval:
+                return self.healthy
+            from . import db
+            try:
+                with db.engines[self.key].connect() as connection:
+                    lag = self.lag(connection)
+                self.healthy = lag <= self.max_lag
+                if not self.healthy:
+                    current_app.logger.warning("Replica in ritardo di %s s: letture sul primario", lag)
+            except SQLAlchemyError as e:
+                current_app.logger.warning("Replica non raggiungibile, letture sul primario: %s", e)
+                self.healthy = False
+            self.checked = time.monotonic()
+            return self.healthy
+
+    @contextmanager
+    def primary(self):
+        # Per i dati che finiscono in una cache condivisa: anche dentro una route sulla replica si legge dal primario,
+        # altrimenti un valore in ritardo resterebbe in cache dopo l'invalidazione che doveva sostituirlo
+        active = self.active()
+        if active:
+            g.replica = False
+        try:
+            yield
+        finally:
+            if active:
+                g.replica = True
+
+    def fail(self):
+        with self.lock:
+            self.healthy = False
+            self.checked = time.monotonic()
+
+    def readonly(self, view):
+        # Per le route che non scrivono: se la replica cade a metà richiesta la route riparte sul primario.
+        # g vale per tutta la richiesta, così anche gli export in streaming leggono dalla replica
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.configured() or not self.check():
+                return view(*args, **kwargs)
+            g.replica = True
+            try:
+                return view(*args, **kwargs)
+            except SQLAlchemyError as e:
+                from . import db
+                current_app.logger.warning("Errore sulla replica, nuovo tentativo sul primario: %s", e)
+                db.session.rollback()
+                self.fail()
+                g.replica = False
+                return view(*args, **kwargs)
+        return wrapper
+
+replicas = Replicas()
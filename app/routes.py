@@ -1,12 +1,25 @@
-from flask import Blueprint, flash, jsonify, render_template, redirect, send_file, url_for, request
+from flask import Blueprint, Response, abort, flash, jsonify, render_template, redirect, send_file, stream_with_context, url_for, request
 from flask_login import current_user, login_required, login_user, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func
-from .models import Utente, Libro, Corso, Prestito, Booking, Review, Ratings, Message
-from .utils import check_email, check_password, convert
+from sqlalchemy.orm import joinedload, undefer
+from .models import Utente, Libro, Corso, Prestito, Booking, Ratings, Message
+from .utils import check_email, check_password, convert, load_cards
+from .search import index
+from .suggest import book_titles, course_names
+from .pagination import paginate
+from .pdf import jobs, cache
+from .counters import counters
+from .stats import book_stats, book_of_month, course_stats, book_report, course_report
+from .analytics import loan_stats, loan_report, stale
+from .scheduler import scheduler
+from .pages import pages
+from .replica import replicas
+from .metrics import metrics
+from .profiler import profiler
+from . import exports, inventory
 from . import db
 from datetime import date, datetime, timedelta
-import math
+import math, os
 
 main = Blueprint('main', __name__)
 
@@ -29,8 +42,76 @@ def internal_server_error(e):
 def forbidden(e):
     return render_template('error.html', error_code=403, error_message='Accesso negato. Non hai i permessi necessari per accedere a questa pagina.'), 403
 
+# Metriche per endpoint in formato Prometheus, riservate ai manager
+@main.route('/metrics', methods=["GET"])
+@login_required
+def mmetrics():
+    if current_user.ruolo != "Manager":
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Profili delle richieste in formato collapsed, da aprire con speedscope o flamegraph.pl
+@main.route('/profile/<name>', methods=["GET"])
+@login_required
+def mprofile(name):
+    if current_user.ruolo != "Manager":
+        abort(403)
+    path = profiler.path(name)
+    if not path or not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='text/plain', as_attachment=True, download_name=name)
+
+# Sezione PDF
+def queue(html, name, tag=None):
+    # html può essere una funzione che lo produce nel job; la cache per tag vale solo per l'HTML già pronto
+    path = cache.get(tag, html) if tag else None
+    if path:
+        return send_file(path, as_attachment=True, download_name=name)
+    
+    id = jobs.submit(html, name, current_user.id, cache.path(tag, html) if tag else None, inline=profiler.active())
+    if not id:
+        return render_template('error.html', error_code=503, error_message='Troppi PDF in preparazione. Per favore riprova tra qualche istante.'), 503
+    
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'id': id, 'status': url_for('main.pstatus', id=id)}), 202
+    return render_template('pdf.html', id=id, name=name), 202
+
+@main.route('/pdf/<id>', methods=["GET"])
+@login_required
+def pstatus(id):
+    job = jobs.job(id)
+    if not job or job['owner'] != current_user.id:
+        return jsonify({"error": "Il PDF richiesto non è stato trovato."}), 404
+    
+    result = {'id': id, 'status': job['status']}
+    if job['status'] == 'done':
+        result['download'] = url_for('main.pfile', id=id)
+    return jsonify(result)
+
+@main.route('/pdf/<id>/download', methods=["GET"])
+@login_required
+def pfile(id):
+    job = jobs.job(id)
+    if not job or job['owner'] != current_user.id or job['status'] != 'done':
+        return render_template('error.html', error_message="Il PDF richiesto non è stato trovato."), 404
+    return send_file(jobs.path(id, '.pdf'), as_attachment=True, download_name=job['name'])
+
+# Export in streaming: /export/loans.csv, /export/payments.ndjson, ...
+@main.route('/export/<name>.<fmt>', methods=["GET"])
+@login_required
+@replicas.readonly
+def export(name, fmt):
+    if name not in exports.EXPORTS or fmt not in exports.FORMATS:
+        return render_template('error.html', error_code=404, error_message='La pagina che stai cercando non esiste.'), 404
+    
+    query = exports.EXPORTS[name](request.args)
+    response = Response(stream_with_context(exports.stream(query, fmt)), mimetype=exports.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
+
 # Welcome page: Pagina di Benvenuto
 @main.route('/', methods=["GET"])
+@pages.cached
 def welcome():
     return render_template('welcome.html')
 
@@ -177,11 +258,8 @@ def phone():
 @main.route('/user', methods=["GET"])
 @login_required
 def uindex():
-    users = Utente.query.all()
-    for user in users:
-        user.lcount = Prestito.query.filter_by(utente_id=user.id).count()
-        user.bcount = Booking.query.filter_by(utente_id=user.id).count()
-    return render_template('uindex.html', users=users)
+    page = paginate(Utente.query.options(undefer(Utente.loan_count), undefer(Utente.booking_count)), {'id': [(Utente.id, False)]})
+    return render_template('uindex.html', users=page.items, page=page)
 
 # Modifica di un utente
 @main.route('/user/<int:id>/edit', methods=["GET", "POST"])
@@ -224,20 +302,19 @@ def udrop(id):
 @main.route('/user/print', methods=["GET"])
 @login_required
 def uprint():
-    users = Utente.query.all()
-    for user in users:
-        user.lcount = Prestito.query.filter_by(utente_id=user.id).count()
-        user.bcount = Booking.query.filter_by(utente_id=user.id).count()
+    users = Utente.query.options(undefer(Utente.loan_count), undefer(Utente.booking_count)).all()
     html = render_template('uprint.html', users=users)
-    pdf = convert(html)
-    return send_file(pdf, as_attachment=True)
+    return queue(html, 'utenti.pdf')
 
 # Tutti i messaggi
 @main.route('/message', methods=["GET"])
 @login_required
 def mindex():
-    messages = Message.query.order_by(Message.msgdate.desc()).all()
-    return render_template('mindex.html', messages=messages)
+    page = paginate(Message.query, {
+        'data': [(Message.msgdate, True), (Message.id, True)],
+        'id': [(Message.id, False)]
+    })
+    return render_template('mindex.html', messages=page.items, page=page)
 
 # Crea un nuovo messaggio
 @main.route('/message/create', methods=["GET", "POST"])
@@ -292,20 +369,15 @@ def mdrop(id):
 
 # Index dei libri
 @main.route('/book', methods=["GET"])
+@pages.cached
 def book():
     if current_user.is_authenticated:
-        genres = Libro.query.with_entities(Libro.genere, func.count(Libro.genere)).group_by(Libro.genere).order_by(Libro.genere).all()
         # Statistiche
-        tbooks = Libro.query.count()
-        tviews = db.session.query(db.func.sum(Libro.viste)).scalar() or 0
-        tdowns = db.session.query(db.func.sum(Libro.download)).scalar() or 0
-        mbooks = Libro.query.order_by(Libro.viste.desc()).limit(5).all()
-        stats = {'tbooks': tbooks, 'tviews': tviews, 'tdowns': tdowns, 'mbooks': mbooks}
-        
-        month = Libro.query.filter_by(libro_mese = "Si").first()
-        return render_template('bindex.html', genres=genres, stats=stats, month=month)
+        dashboard = book_stats()
+        month, ends = book_of_month()
+        return render_template('bindex.html', genres=dashboard['genres'], stats=dashboard['stats'], month=month, ends=ends)
     else:
-        genres = Libro.query.with_entities(Libro.genere, func.count(Libro.genere)).group_by(Libro.genere).order_by(Libro.genere).all()
+        genres = book_stats()['genres']
         books = {}
         for genre in genres:
             b = Libro.query.filter_by(genere = genre[0]).order_by(Libro.id).limit(5).all()
@@ -316,27 +388,15 @@ def book():
 @main.route('/group', methods=["GET"])
 @login_required
 def group():
-    month = Libro.query.filter_by(libro_mese='Si').first()
+    month, ends = book_of_month()
     return render_template('group.html', month=month)
 
 # Book of a certain Genre
 @main.route('/book/genere', methods=["POST"])
+@replicas.readonly
 def bview():
     genre = request.form.get('genere')
-    books = Libro.query.filter(Libro.genere.like(f'%{genre}%')).order_by(Libro.titolo).all()
-    ends = {}
-    reviews = {}
-    for book in books:
-        loans = Prestito.query.filter_by(libro_id = book.id).all()
-        end = ''
-        for loan in loans:
-            if loan.terminato == "No":
-                end = loan.rientro.strftime('%d-%m-%Y')
-        ends[book.id] = end
-        
-        revs = Review.query.filter_by(libro_id = book.id).all()
-        reviews[book.id] = revs
-
+    books, ends, reviews = load_cards(Libro.query.filter(Libro.genere.like(f'%{genre}%')).order_by(Libro.titolo))
     return render_template('bview.html', books=books, genre=genre, ends=ends, reviews=reviews)
 
 # Book of Genre Print
@@ -345,8 +405,7 @@ def bview():
 def bprint(genere):
     books = Libro.query.filter_by(genere=genere).order_by(Libro.titolo).all()
     html = render_template('bprint.html', books=books, genre=genere)
-    pdf = convert(html)    
-    return send_file(pdf, as_attachment=True)
+    return queue(html, f'{genere}.pdf', tag=f'genre-{genere}')
 
 # Book Scheda
 @main.route('/book/<int:id>/download', methods=["GET"])
@@ -356,12 +415,13 @@ def bdownload(id):
     if not book:
         return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
     
-    book.download += 1
-    db.session.commit()
+    counters.incr(Libro, 'download', id)
     
     html = render_template('bdownload.html', book=book)
-    pdf = convert(html)    
-    return send_file(pdf, as_attachment=True)
+    pdf = cache.get(f'book-{id}', html)
+    if not pdf:
+        pdf = cache.put(f'book-{id}', html, convert(html))
+    return send_file(pdf, as_attachment=True, download_name=f'libro-{id}.pdf')
 
 # Book related
 @main.route('/book/<int:id>/related', methods=["GET"])
@@ -370,8 +430,7 @@ def brelated(id):
     if not book:
         return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
     
-    book.viste += 1
-    db.session.commit()
+    counters.incr(Libro, 'viste', id)
     related_by_genre = Libro.query.filter(Libro.genere == book.genere, Libro.id != id).limit(5).all()
     related_by_author = Libro.query.filter(Libro.autore == book.autore, Libro.id != id).limit(5).all()
     books = {book.id: book for book in related_by_genre + related_by_author}.values() 
@@ -379,41 +438,53 @@ def brelated(id):
     return render_template('brelated.html', book=book, books=books)
 
 # Book Stats
+def period():
+    # Intervallo ?start=YYYY-MM-DD&end=YYYY-MM-DD; di default gli ultimi due anni
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else date.today().replace(day=1) - timedelta(days=730)
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else None
+    except ValueError:
+        start, end = date.today().replace(day=1) - timedelta(days=730), None
+    return start, end
+
 @main.route('/book/<int:id>/stats', methods=["GET"])
 @login_required
+@replicas.readonly
 def bstats(id):
     book = db.session.get(Libro, id)    
     if not book:
         return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
    
-    total_loans = Prestito.query.filter_by(libro_id=id).count()
-    reviews = Review.query.filter_by(libro_id=id).all()
-    if reviews:
-        average_rating = sum(review.rating for review in reviews) / len(reviews)
-        rating_distribution = {i: 0 for i in range(1, 6)}
-        for review in reviews:
-            rating_distribution[review.rating] += 1
-    else:
-        average_rating = 0
-        rating_distribution = {i: 0 for i in range(1, 6)}
+    start, end = period()
+    stats = book_report(id, start, end)
+    return render_template('bstats.html', book=book, start=start, end=end, **stats)
 
-    loan_dates = Prestito.query.filter_by(libro_id = id).all()
-    monthly_loans = {}
-    for loan in loan_dates:
-        month = loan.uscita.strftime('%Y-%m')
-        if month not in monthly_loans:
-            monthly_loans[month] = 0
-        monthly_loans[month] += 1
+@main.route('/book/<int:id>/stats/json', methods=["GET"])
+@login_required
+@replicas.readonly
+def bstatsjson(id):
+    book = db.session.get(Libro, id)    
+    if not book:
+        return jsonify({"error": "Il libro richiesto non è stato trovato."}), 404
     
-    return render_template('bstats.html', book=book, total_loans=total_loans, average_rating=average_rating,
-        rating_distribution=rating_distribution, monthly_loans=monthly_loans)
+    start, end = period()
+    stats = book_report(id, start, end)
+    stats['id'] = id
+    stats['titolo'] = book.titolo
+    stats['monthly_loans'] = [{'month': month, 'loans': count} for month, count in stats['monthly_loans'].items()]
+    return jsonify(stats)
 
 # Area manager per i libri
 @main.route('/book/manager', methods=["GET"])
 @login_required
 def bmanager():
-    books = Libro.query.all()
-    return render_template('bmanager.html', books=books)
+    page = paginate(Libro.query, {
+        'id': [(Libro.id, False)],
+        'titolo': [(Libro.titolo, False), (Libro.id, False)],
+        'autore': [(Libro.autore, False), (Libro.id, False)],
+        'viste': [(Libro.viste, True), (Libro.id, True)]
+    })
+    return render_template('bmanager.html', books=page.items, page=page)
 
 # Book Create
 @main.route('/book/create', methods=["GET", "POST"])
@@ -424,7 +495,7 @@ def bcreate():
     
     book = Libro(
         titolo = request.form['titolo'],
-        anno = request.form['anno'],
+        anno = request.form.get('anno', type=int),
         classificazione = request.form['classificazione'],
         posizione = request.form['posizione'],
         autore = request.form['autore'],
@@ -442,6 +513,9 @@ def bcreate():
 
     db.session.add(book)
     db.session.commit()        
+    index.add(book)
+    book_titles.add(book)
+    cache.invalidate(f'genre-{book.genere}')
     return redirect(url_for('main.book'))   
 
 # Book edit
@@ -455,8 +529,9 @@ def bedit(id):
     if request.method == 'GET':
         return render_template('bedit.html', book=book)
     
+    genre = book.genere
     book.titolo = request.form['titolo']
-    book.anno = request.form['anno']
+    book.anno = request.form.get('anno', type=int)
     book.classificazione = request.form['classificazione']
     book.posizione = request.form['posizione']
     book.autore = request.form['autore']
@@ -472,6 +547,9 @@ def bedit(id):
     book.download = request.form['download']
 
     db.session.commit()
+    index.add(book)
+    book_titles.add(book)
+    cache.invalidate(f'book-{id}', f'genre-{genre}', f'genre-{book.genere}')
     return redirect(url_for('main.book'))
     
 # Book drop
@@ -483,69 +561,43 @@ def bdrop(id):
     if not book:
         return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
     
+    genre = book.genere
     db.session.delete(book)
     db.session.commit()
+    index.remove(id)
+    book_titles.remove(id)
+    cache.invalidate(f'book-{id}', f'genre-{genre}')
     return redirect(url_for('main.book'))
 
 # Ricerche 
 @main.route('/book/search/titolo', methods=["POST"])
 @login_required
+@replicas.readonly
 def btitle():
     title = request.form.get('titolo')
-    books = Libro.query.filter(Libro.titolo.like(f'%{title}%')).all()
-    ends = {}
-    reviews = {}
-    for book in books:
-        loans = Prestito.query.filter_by(libro_id = book.id).all()
-        end = ''
-        for loan in loans:
-            if loan.terminato == "No":
-                end = loan.rientro.strftime('%d-%m-%Y')
-        ends[book.id] = end
-        
-        revs = Review.query.filter_by(libro_id = book.id).all()
-        reviews[book.id] = revs
-    
+    ids = index.search(title, field='titolo')
+    books, ends, reviews = load_cards(Libro.query.filter(Libro.id.in_(ids)), order=ids)
+
     return render_template('bsearch.html', books=books, hidden="Titolo", ends=ends, reviews=reviews)
 
 @main.route('/book/search/autore', methods=["POST"])
 @login_required
+@replicas.readonly
 def bauthor():
     author = request.form.get('autore')
-    books = Libro.query.filter(Libro.autore.like(f'%{author}%')).all()
-    ends = {}
-    reviews = {}
-    for book in books:
-        loans = Prestito.query.filter_by(libro_id = book.id).all()
-        end = ''
-        for loan in loans:
-            if loan.terminato == "No":
-                end = loan.rientro.strftime('%d-%m-%Y')
-        ends[book.id] = end
-        
-        revs = Review.query.filter_by(libro_id = book.id).all()
-        reviews[book.id] = revs
-    
+    ids = index.search(author, field='autore')
+    books, ends, reviews = load_cards(Libro.query.filter(Libro.id.in_(ids)), order=ids)
+
     return render_template('bsearch.html', books=books, hidden="Autore", ends=ends, reviews=reviews)
 
 @main.route('/book/search/genere', methods=["POST"])
 @login_required
+@replicas.readonly
 def bgenre():
     genre = request.form.get('genere')
-    books = Libro.query.filter(Libro.genere.like(f'%{genre}%')).all()
-    ends = {}
-    reviews = {}
-    for book in books:
-        loans = Prestito.query.filter_by(libro_id = book.id).all()
-        end = ''
-        for loan in loans:
-            if loan.terminato == "No":
-                end = loan.rientro.strftime('%d-%m-%Y')
-        ends[book.id] = end
-        
-        revs = Review.query.filter_by(libro_id = book.id).all()
-        reviews[book.id] = revs
-    
+    ids = index.search(genre, field='genere')
+    books, ends, reviews = load_cards(Libro.query.filter(Libro.id.in_(ids)), order=ids)
+
     return render_template('bsearch.html', books=books, hidden="Genere", ends=ends, reviews=reviews)
 
 # Area manager per i prestiti
@@ -558,12 +610,11 @@ def lindex():
 @main.route('/suggest', methods=["GET"])
 def suggest():
     query = request.args.get('query', '')
-    suggestions = []
-    
-    if query:
-        books = Libro.query.filter(Libro.titolo.like(f'%{query}%')).all()
-        suggestions = [book.titolo for book in books]
-    return jsonify(suggestions) 
+    k = request.args.get('k', type=int)
+    response = jsonify(book_titles.complete(query, k))
+    response.cache_control.public = True
+    response.cache_control.max_age = 30
+    return response
 
 # Creazione del prestito
 @main.route('/loan/create', methods=["GET", "POST"])
@@ -575,19 +626,20 @@ def lcreate():
     titolo = request.form.get('titolo')
     uscita = datetime.strptime(request.form.get('uscita'), '%Y-%m-%d')
     
-    book = Libro.query.filter(Libro.titolo.like('%' + titolo + '%')).first()
+    # Il libro scelto dai suggerimenti; altrimenti solo un titolo uguale a quello scritto, mai uno simile
+    libro_id = request.form.get('libro_id', type=int)
+    if libro_id:
+        book = db.session.get(Libro, libro_id)
+    else:
+        ids = index.exact(titolo, 'titolo')
+        book = Libro.query.filter(Libro.id.in_(ids)).order_by((Libro.copie > 0).desc(), Libro.id).first() if ids else None
     if not book:
         return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
     
     rientro = uscita + timedelta(days = 30 if book.rivista == 'No' else 15)
     
-    loan = Prestito(uscita=uscita, rientro=rientro, terminato='No', restituito="No", prorogato='No', libro_id=book.id, utente_id=current_user.id)
-    db.session.add(loan)
-    
-    book.copie -= 1
-    if book.copie == 0:
-        book.disponibile = 'No'
-    db.session.commit()        
+    if not inventory.lend(book.id, current_user.id, uscita, rientro):
+        return render_template('error.html', error_message="Non ci sono copie disponibili del libro richiesto.")
     
     if current_user.ruolo == "Manager":
         return redirect(url_for('main.lindex')) 
@@ -597,7 +649,12 @@ def lcreate():
 @main.route('/loan/all', methods=["GET"])
 @login_required
 def lall():
-    loans = Prestito.query.all()
+    page = paginate(Prestito.query.options(joinedload(Prestito.libro), joinedload(Prestito.utente)), {
+        'id': [(Prestito.id, False)],
+        'uscita': [(Prestito.uscita, True), (Prestito.id, True)],
+        'rientro': [(Prestito.rientro, False), (Prestito.id, False)]
+    })
+    loans = page.items
     day = {}
     for loan in loans:
         if loan.terminato == "Si":
@@ -607,15 +664,20 @@ def lall():
             end = loan.rientro
             day[loan.id] = math.ceil((end - now).days)    
    
-    return render_template('lall.html', loans=loans, day=day)
+    return render_template('lall.html', loans=loans, day=day, page=page)
+
+# I report sui prestiti arrivano dalla fotografia dello scheduler; al primo accesso del giorno la si calcola subito
+def report(name):
+    scheduler.start()
+    if stale():
+        scheduler.trigger('loan_reports')
+    return loan_report(name)
 
 # Prestiti in Scadenza
 @main.route('/loan/expiring', methods=["GET"])
 @login_required
 def lexpiring():
-    today = datetime.today()
-    limit = today + timedelta(days=7)
-    loans = Prestito.query.filter(Prestito.rientro <= limit, Prestito.rientro >= today).all()
+    loans = report('expiring')
     
     return render_template('lexpiring.html', loans=loans)
 
@@ -634,54 +696,71 @@ def lshistory():
     
 # Cronologia per Libro
 @main.route('/loan/history/book/<int:id>', methods=["GET"])
+@replicas.readonly
 def lbhistory(id):
     book = Libro.query.get(id)    
     if not book:
         return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
-    loans = Prestito.query.filter_by(libro_id=id).all()
+    page = paginate(Prestito.query.filter_by(libro_id=id).options(joinedload(Prestito.libro), joinedload(Prestito.utente)), {
+        'id': [(Prestito.id, False)],
+        'uscita': [(Prestito.uscita, True), (Prestito.id, True)]
+    })
 
-    return render_template('lbhistory.html', loans=loans, book=book)
+    return render_template('lbhistory.html', loans=page.items, book=book, page=page)
 
 # Cronologia per Utente
 @main.route('/loan/history/user/<int:id>', methods=["GET"])
+@replicas.readonly
 def luhistory(id):
     user = db.session.get(Utente, id) 
     if not user:
         return render_template('error.html', error_message="L'utente richiesto non è stato trovato.")
-    loans = Prestito.query.filter_by(utente_id=id).all()
+    page = paginate(Prestito.query.filter_by(utente_id=id).options(joinedload(Prestito.libro), joinedload(Prestito.utente)), {
+        'id': [(Prestito.id, False)],
+        'uscita': [(Prestito.uscita, True), (Prestito.id, True)]
+    })
     
-    return render_template('luhistory.html', loans=loans, user=user)
+    return render_template('luhistory.html', loans=page.items, user=user, page=page)
 
 # Prestiti non rientrati
 @main.route('/loan/overdue', methods=["GET"])
 def loverdue():
-    loans = Prestito.query.filter(Prestito.rientro < datetime.today().date(), Prestito.restituito == "No").all()
+    loans = report('overdue')
     
     return render_template('loverdue.html', loans=loans)
 
 # Loan Stats
 @main.route('/loan/stats', methods=["GET"])
 def lstats():
-    tloans = Prestito.query.count()
-    loans = Prestito.query.all()
-    total_duration = sum([(loan.uscita - loan.rientro).days for loan in loans])
-    average_duration = total_duration / len(loans) if loans else 0
-    
-    overdue_loans_count = Prestito.query.filter(Prestito.rientro < datetime.today().date(), Prestito.restituito == "No").count()
-    current_loans_count = Prestito.query.filter(Prestito.rientro >= datetime.today().date()).count()
-
-    return render_template('lstats.html', tloans=tloans, average_duration=average_duration,
-        overdue_loans_count=overdue_loans_count, current_loans_count=current_loans_count)
+    stats = loan_stats()
+    return render_template('lstats.html', **stats)
 
 # Loan strani
 @main.route('/loan/reports/alerts', methods=["GET"])
 def lalerts():
     # Prestiti con durata insolita (es. più di 90 giorni)
-    unusual_duration_loans = Prestito.query.filter((Prestito.rientro - Prestito.uscita) > timedelta(days=90)).all()
+    unusual_duration_loans = report('unusual')
     # Prestiti non restituiti (scaduti e non terminati)
-    overdue_loans = Prestito.query.filter(Prestito.rientro < datetime.today().date(), Prestito.restituito == "No").all()
+    overdue_loans = report('overdue')
     
-    return render_template('lalert.html', unusual_duration_loans=unusual_duration_loans, overdue_loans=overdue_loans)
+    return render_template('lalert.html', unusual_duration_loans=unusual_duration_loans, overdue_loans=overdue_loans,
+        status=scheduler.status()['loan_reports'])
+
+# Ricalcolo manuale dei report sui prestiti
+@main.route('/loan/reports/refresh', methods=["POST"])
+@login_required
+def lrefresh():
+    ok = scheduler.trigger('loan_reports')
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(scheduler.status()['loan_reports']), 200 if ok else 500
+    if not ok:
+        flash('Aggiornamento dei report non riuscito.', 'error')
+    return redirect(url_for('main.lalerts'))
+
+# Ultimo ricalcolo dei report: ora, durata ed eventuale errore
+@main.route('/loan/reports/status', methods=["GET"])
+def lreports():
+    return jsonify(scheduler.status())
 
 # Terminazione
 @main.route('/loan/<int:id>/term', methods=["GET"])
@@ -691,18 +770,8 @@ def lterm(id):
     if not loan:
         return render_template('error.html', error_message="Il prestito richiesto non è stato trovato.")
     
-    loan.terminato = "Si"
-    loan.rientro = date.today()
-    loan.restituito = "Si"
-    
-    book = db.session.get(Libro, loan.libro_id)
-    if not book:
-        return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
-    
-    book.copie += 1
-    if book.copie > 0:
-        book.disponibile = "Si"
-    db.session.commit()    
+    if not inventory.terminate(loan.id, date.today()):
+        return render_template('error.html', error_message="Il prestito richiesto è già stato terminato.")
     
     return redirect(url_for('main.lindex'))
 
@@ -710,21 +779,9 @@ def lterm(id):
 @main.route('/loan/<int:id>/delete', methods=["POST"])
 @login_required
 def ldrop(id):
-    loan = db.session.get(Prestito, id)    
-    if not loan:
+    if not inventory.remove(id):
         return render_template('error.html', error_message="Il prestito richiesto non è stato trovato.")
     
-    book = db.session.get(Libro, loan.libro_id)
-    if not book:
-        return render_template('error.html', error_message="Il libro richiesto non è stato trovato.")
-    
-    if loan.terminato == 'No':
-        book.copie += 1
-        if book.copie > 0:
-            book.disponibile = 'Si'
-    db.session.delete(loan)
-    db.session.commit()    
-    
     return redirect(url_for('main.lindex'))
 
 # Extension
@@ -748,6 +805,35 @@ def lextend(id):
         return redirect(url_for('main.uprofile', id=current_user.id))
     return redirect(url_for('main.lindex'))  
 
+# Operazioni a blocchi dal banco prestiti: {"loans": [1, 2]} oppure {"books": [7, 7, 9]} (anche da form)
+def batch_ids(data, name):
+    value = data.get(name) or []
+    if isinstance(value, str):
+        value = value.replace(',', ' ').split()
+    return [int(v) for v in value]
+
+@main.route('/loan/batch/<action>', methods=["POST"])
+@login_required
+def lbatch(action):
+    if action not in ('term', 'extend', 'delete'):
+        return jsonify({"error": "Operazione non valida."}), 404
+    
+    data = request.get_json(silent=True) or request.form
+    if not isinstance(data, dict):
+        return jsonify({"error": "Il corpo JSON deve essere un oggetto con 'loans' e/o 'books'."}), 400
+    try:
+        loan_ids, book_ids = batch_ids(data, 'loans'), batch_ids(data, 'books')
+    except (TypeError, ValueError):
+        return jsonify({"error": "Gli ID devono essere numeri interi."}), 400
+    if not loan_ids and not book_ids:
+        return jsonify({"error": "Nessun prestito o libro indicato."}), 400
+    if len(loan_ids) + len(book_ids) > inventory.BATCH:
+        return jsonify({"error": f"Al massimo {inventory.BATCH} voci per richiesta."}), 400
+    
+    items = inventory.batch(action, loan_ids, book_ids)
+    done = sum(1 for item in items if item['result'] == 'ok')
+    return jsonify({'action': action, 'ok': done, 'failed': len(items) - done, 'items': items})
+
 # Print my loans
 @main.route('/loan/print', methods=["GET"])
 @login_required
@@ -761,21 +847,21 @@ def lprint():
 @main.route('/loan/download', methods=["GET"])
 @login_required
 def ldownload():
-    loans = Prestito.query.all()
-    html = render_template('ldownload.html', loans=loans)
-    pdf = convert(html)    
-    return send_file(pdf, as_attachment=True)
+    # Tutti i prestiti: query e template si eseguono nel job, non nel thread della richiesta
+    def html():
+        loans = Prestito.query.options(joinedload(Prestito.libro), joinedload(Prestito.utente)).all()
+        return render_template('ldownload.html', loans=loans)
+    return queue(html, 'prestiti.pdf')
 
 # Course
 @main.route('/course', methods=["GET"])
+@pages.cached
 def cindex():
     if current_user.is_authenticated:
         courses = Corso.query.all()
         for course in courses:
             course.place = course.massimo - course.prenotazioni
-        tview = db.session.query(db.func.sum(Corso.viste)).scalar() or 0
-        mcourses = Corso.query.order_by(Corso.viste.desc()).limit(3).all()
-        stats = {'tview': tview, 'mcourses': mcourses}        
+        stats = course_stats()
         ratings = Ratings.query.filter_by(corso_id = course.id).all()
        
         return render_template('cindex.html', courses=courses, stats=stats, ratings=ratings)
@@ -788,8 +874,11 @@ def cindex():
 @main.route('/course/manager', methods=["GET"])
 @login_required
 def cmanager():
-    courses = Corso.query.all()
-    return render_template('cmanager.html', courses=courses)
+    page = paginate(Corso.query, {
+        'id': [(Corso.id, False)],
+        'nome': [(Corso.nome, False), (Corso.id, False)]
+    })
+    return render_template('cmanager.html', courses=page.items, page=page)
 
 # Create course
 @main.route('/course/create', methods=["GET", "POST"])
@@ -815,6 +904,8 @@ def ccreate():
     )
     db.session.add(course)
     db.session.commit() 
+    course_names.add(course)
+    cache.invalidate('courses')
 
     return redirect(url_for('main.cindex'))
 
@@ -845,6 +936,8 @@ def cedit(id):
     course.viste = request.form['viste']
 
     db.session.commit()
+    course_names.add(course)
+    cache.invalidate('courses')
     return redirect(url_for('main.cindex'))
     
 # Cours edrop
@@ -857,6 +950,8 @@ def cdrop(id):
     
     db.session.delete(course)
     db.session.commit()    
+    course_names.remove(id)
+    cache.invalidate('courses')
     return redirect(url_for('main.cindex'))
 
 # Print the course
@@ -865,8 +960,7 @@ def cdrop(id):
 def cprint():
     courses = Corso.query.all()  
     html = render_template('cprint.html', courses=courses)
-    pdf= convert(html)
-    return send_file(pdf, as_attachment=True)
+    return queue(html, 'corsi.pdf', tag='courses')
 
 # Booking
 @main.route('/booking', methods=["GET"])
@@ -878,13 +972,11 @@ def pindex():
 @main.route('/suggests', methods=["GET"])
 def suggests():
     query = request.args.get('query', '')
-    suggestions = []
-    
-    if query:
-        courses = Corso.query.filter(Corso.nome.like(f'%{query}%')).all()
-        suggestions = [course.nome for course in courses]
-    
-    return jsonify(suggestions) 
+    k = request.args.get('k', type=int)
+    response = jsonify(course_names.complete(query, k))
+    response.cache_control.public = True
+    response.cache_control.max_age = 30
+    return response
 
 # Booking create
 @main.route('/booking/create', methods=["GET", "POST"])
@@ -898,11 +990,8 @@ def pcreate():
     if not course:
         return render_template('error.html', error_message="Il corso richiesto non è stato trovato.")
     
-    booking = Booking(state="Pending", bdate=date.today(), corso_id=course.id, utente_id=current_user.id)
-    db.session.add(booking)
-    
-    course.prenotazioni += 1
-    db.session.commit()        
+    if not inventory.reserve(course.id, current_user.id, date.today()):
+        return render_template('error.html', error_message="Non ci sono più posti disponibili per il corso richiesto.")
     
     if current_user.ruolo == "Manager":
         return redirect(url_for('main.pindex'))  
@@ -926,16 +1015,8 @@ def pconfirm(id):
     if not booking:
         return render_template('error.html', error_message="La prenotazione richiesta non è stata trovata.")
     
-    booking.state = "Confirmed"
-    db.session.commit()    
-    
-    course = db.session.get(Corso, booking.corso_id)
-    if not course:
-        return render_template('error.html', error_message="Il corso richiesto non è stato trovato.")
-    
-    course.prenotazioni -= 1
-    course.iscrizioni += 1
-    db.session.commit()    
+    if not inventory.confirm(booking.id, booking.corso_id):
+        return render_template('error.html', error_message="La prenotazione richiesta è già stata gestita.")
     return redirect(url_for('main.pindex'))
 
 # Booking reject
@@ -945,20 +1026,15 @@ def preject(id):
     if not booking:
         return render_template('error.html', error_message="La prenotazione richiesta non è stata trovata.")
 
-    booking.state = 'Rejected'
-    
-    course = db.session.get(Corso, booking.corso_id)
-    if not course:
-        return render_template('error.html', error_message="Il corso richiesto non è stato trovato.")
-    course.prenotazioni -= 1
-    db.session.commit()
+    if not inventory.reject(booking.id, booking.corso_id):
+        return render_template('error.html', error_message="La prenotazione richiesta è già stata gestita.")
     
     return redirect(url_for('main.pindex'))
 
 # Booking payments
 @main.route('/booking/payments', methods=["GET"])
 def ppayments():
-    bookings = Booking.query.all()
+    bookings = Booking.query.options(joinedload(Booking.corso), joinedload(Booking.utente)).all()
     payments = []
 
     for booking in bookings:
@@ -990,30 +1066,21 @@ def ppending():
     return render_template('ppending.html', bookings=pending_bookings)
 
 @main.route('/booking/stats', methods=["GET"])
+@replicas.readonly
 def pstats():
-    corsi = Corso.query.all()
-    total_bookings = Booking.query.count()  # Numero totale di prenotazioni
-    stats = []
-
-    for corso in corsi:
-        bookings_for_course = Booking.query.filter_by(corso_id=corso.id).count()  # Prenotazioni per corso
-        fill_rate = (corso.iscrizioni / corso.massimo) * 100  # Percentuale di riempimento
-        stats.append({
-            'corso': corso.nome,
-            'prenotazioni': bookings_for_course,
-            'iscrizioni': corso.iscrizioni,
-            'posti_max': corso.massimo,
-            'riempimento': round(fill_rate, 2),  # Arrotonda al 2 decimali
-            'viste': corso.viste  # Numero di visualizzazioni
-        })
+    report = course_report()
+    return render_template('pstats.html', stats=report['stats'], total_bookings=report['total_bookings'])
 
-    return render_template('pstats.html', stats=stats, total_bookings=total_bookings)
+@main.route('/booking/stats/json', methods=["GET"])
+@replicas.readonly
+def pstatsjson():
+    return jsonify(course_report())
 
 @main.route('/booking/users', methods=["GET"])
 def pusers():
-    users = Utente.query.all()
+    page = paginate(Utente.query, {'id': [(Utente.id, False)]})
     
-    return render_template('pusers.html', users=users)
+    return render_template('pusers.html', users=page.items, page=page)
 
 @main.route('/booking/user', methods=["POST"])
 def puser():
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+import os, threading, time
+
+class Scheduler:
+    # Job periodici eseguiti da un thread del processo, a intervalli fissi e/o a mezzanotte
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.jobs = {}
+        self.app = None
+        self.thread = None
+        self.pid = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def add(self, name, f, interval, midnight=False):
+        self.jobs[name] = {'f': f, 'interval': interval, 'midnight': midnight, 'lock': threading.Lock(),
+            'next': 0, 'last': None, 'duration': None, 'error': None}
+
+    def start(self):
+        # Un thread per processo: dopo un fork va ricreato
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            now = time.time()
+            for name, job in self.jobs.items():
+                if job['next'] <= now:
+                    self.trigger(name)
+            wait = min((job['next'] for job in self.jobs.values()), default=now + 60) - time.time()
+            self.wake.wait(max(wait, 1))
+            self.wake.clear()
+
+    def trigger(self, name):
+        # Esegue subito il job; se è già in corso aspetta che finisca invece di ripeterlo
+        job = self.jobs[name]
+        if not job['lock'].acquire(blocking=False):
+            with job['lock']:
+                return job['error'] is None
+        try:
+            start = time.perf_counter()
+            with self.app.app_context():
+                try:
+                    job['f']()
+                    job['error'] = None
+                except Exception as e:
+                    self.app.logger.warning("Job %s non riuscito: %s", name, e)
+                    job['error'] = str(e)
+            job['last'] = datetime.now()
+            job['duration'] = time.perf_counter() - start
+            job['next'] = self.next(job)
+            return job['error'] is None
+        finally:
+            job['lock'].release()
+
+    def next(self, job):
+        now = datetime.now()
+        next = now + timedelta(seconds=job['interval'])
+        if job['midnight']:
+            next = min(next, datetime.combine(now.date() + timedelta(days=1), datetime.min.time()))
+        return next.timestamp()
+
+    def status(self):
+        return {name: {
+            'last': job['last'].isoformat(timespec='seconds') if job['last'] else None,
+            'duration': round(job['duration'], 3) if job['duration'] is not None else None,
+            'next': datetime.fromtimestamp(job['next']).isoformat(timespec='seconds') if job['next'] else None,
+            'error': job['error']
+        } for name, job in self.jobs.items()}
+
+scheduler = Scheduler()
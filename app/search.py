@@ -0,0 +1,180 @@
+from sqlalchemy.exc import SQLAlchemyError
+from .utils import Stamp
+from .replica import replicas
+import os, re, tempfile, threading, unicodedata
+
+# Campi indicizzati e relativo peso nel punteggio
+FIELDS = {'titolo': 3.0, 'autore': 2.0, 'genere': 1.5, 'collana': 1.0, 'note': 0.5}
+
+def fold(text):
+    # Minuscolo e senza accenti: "Città" -> "citta"
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+def tokenize(text):
+    return re.findall(r'\w+', fold(text))
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+class SearchIndex:
+    # Indice invertito in memoria sul catalogo dei libri
+    def __init__(self, similarity=0.4):
+        self.similarity = similarity
+        self.lock = threading.RLock()
+        self.building = threading.Lock()
+        self.stamp = Stamp(os.path.join(tempfile.gettempdir(), 'library-search.stamp'))
+        self.seen = None
+        self.clear()
+
+    def init_app(self, app):
+        self.stamp.path = app.config.get('SEARCH_STAMP', self.stamp.path)
+        with app.app_context():
+            try:
+                self.rebuild()
+            except SQLAlchemyError as e:
+                app.logger.warning("Indice di ricerca non costruito: %s", e)
+
+    def clear(self):
+        self.docs = {}
+        self.postings = {field: {} for field in FIELDS}
+        self.vocab = {}
+        self.grams = {}
+
+    def rebuild(self):
+        from .models import Libro
+        # La versione si legge prima della query: una modifica che arriva durante la lettura forza un altro giro
+        version = self.stamp.version()
+        with replicas.primary():
+            rows = Libro.query.with_entities(Libro.id, *[getattr(Libro, field) for field in FIELDS]).all()
+        with self.lock:
+            self.clear()
+            for row in rows:
+                self._add(row[0], dict(zip(FIELDS, row[1:])))
+            self.seen = version
+
+    def changed(self):
+        # Il file di versione segnala le modifiche fatte dagli altri processi: si ricostruisce l'indice.
+        # Una ricostruzione alla volta; chi aspettava il lock di solito trova l'indice già aggiornato
+        if self.stamp.version() != self.seen:
+            with self.building:
+                if self.stamp.version() != self.seen:
+                    self.rebuild()
+
+    def publish(self):
+        # Dopo una modifica locale: gli altri processi ricostruiscono, questo resta allineato
+        current = self.stamp.version() == self.seen
+        version = self.stamp.touch()
+        if current:
+            self.seen = version
+
+    def invalidate(self):
+        # Per chi scrive sul catalogo senza passare da add/remove (es. il comando ingest)
+        self.stamp.touch()
+
+    def add(self, book):
+        with self.lock:
+            self._remove(book.id)
+            self._add(book.id, {field: getattr(book, field) for field in FIELDS})
+            self.publish()
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+            self.publish()
+
+    def _add(self, id, values):
+        doc = {field: set(tokenize(values[field])) for field in FIELDS}
+        self.docs[id] = doc
+        for field, tokens in doc.items():
+            for token in tokens:
+                self.postings[field].setdefault(token, set()).add(id)
+                self.vocab[token] = self.vocab.get(token, 0) + 1
+                if self.vocab[token] == 1:
+                    for gram in trigrams(token):
+                        self.grams.setdefault(gram, set()).add(token)
+
+    def _remove(self, id):
+        doc = self.docs.pop(id, None)
+        if not doc:
+            return
+        for field, tokens in doc.items():
+            for token in tokens:
+                ids = self.postings[field][token]
+                ids.discard(id)
+                if not ids:
+                    del self.postings[field][token]
+                self.vocab[token] -= 1
+                if not self.vocab[token]:
+                    del self.vocab[token]
+                    for gram in trigrams(token):
+                        self.grams[gram].discard(token)
+                        if not self.grams[gram]:
+                            del self.grams[gram]
+
+    def expand(self, token):
+        # Termini del vocabolario che corrispondono al token, con un peso tra 0 e 1
+        if len(token) < 3:
+            return {term: 1.0 if term == token else 0.8 for term in self.vocab if term.startswith(token)} or \
+                {term: 0.5 for term in self.vocab if token in term}
+
+        grams = trigrams(token)
+        shared = {}
+        for gram in grams:
+            for term in self.grams.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+
+        terms = {}
+        for term, count in shared.items():
+            if term == token:
+                terms[term] = 1.0
+            elif token in term:
+                terms[term] = 0.8 if term.startswith(token) else 0.6
+            else:
+                score = 2 * count / (len(grams) + len(trigrams(term)))
+                if score >= self.similarity:
+                    terms[term] = score * 0.5
+        return terms
+
+    def exact(self, text, field):
+        # ID dei libri in cui il campo ha esattamente le parole del testo, a meno di maiuscole, accenti e punteggiatura
+        self.changed()
+        tokens = set(tokenize(text))
+        if not tokens:
+            return []
+        with self.lock:
+            ids = set.intersection(*(self.postings[field].get(token, set()) for token in tokens))
+            return sorted(id for id in ids if self.docs[id][field] == tokens)
+
+    def search(self, text, field=None, limit=None):
+        # Restituisce gli ID dei libri ordinati per rilevanza
+        self.changed()
+        fields = [field] if field else list(FIELDS)
+
+        with self.lock:
+            tokens = tokenize(text)
+            if not tokens:
+                # Come LIKE '%%': una ricerca vuota restituisce tutto il catalogo
+                ids = [] if text and text.strip() else sorted(self.docs)
+                return ids[:limit] if limit else ids
+
+            scores = None
+            for token in tokens:
+                matches = {}
+                for term, weight in self.expand(token).items():
+                    for f in fields:
+                        for id in self.postings[f].get(term, ()):
+                            score = weight * FIELDS[f]
+                            if score > matches.get(id, 0):
+                                matches[id] = score
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {id: scores[id] + score for id, score in matches.items() if id in scores}
+                if not scores:
+                    return []
+
+        ids = sorted(scores, key=lambda id: (-scores[id], id))
+        return ids[:limit] if limit else ids
+
+index = SearchIndex()
@@ -0,0 +1,163 @@
+from sqlalchemy import case, func
+from types import SimpleNamespace
+from .models import Libro, Corso, Prestito, Review, Booking
+from .events import counters, on_commit
+from .utils import TTLCache, Stamp
+from .replica import replicas
+from . import db
+import os, tempfile
+
+class Dashboard:
+    # Aggregati delle dashboard: cambiano di rado, li ricalcoliamo alla scadenza o dopo una scrittura.
+    # Un file di versione per voce porta le invalidazioni anche agli altri processi
+    def __init__(self, ttl):
+        self.cache = TTLCache(ttl)
+        self.directory = tempfile.gettempdir()
+        self.stamps = {}
+        self.seen = {}
+
+    def init_app(self, app):
+        self.cache.ttl = app.config.get('STATS_TTL', self.cache.ttl)
+        self.directory = app.config.get('STATS_STAMP_DIR', self.directory)
+
+    def stamp(self, key):
+        if key not in self.stamps:
+            self.stamps[key] = Stamp(os.path.join(self.directory, 'library-dashboard-%s.stamp' % key))
+        return self.stamps[key]
+
+    def get(self, key, compute):
+        version = self.stamp(key).version()
+        if version != self.seen.get(key):
+            self.cache.invalidate(key)
+            self.seen[key] = version
+        return self.cache.get(key, lambda: self.fill(compute))
+
+    def fill(self, compute):
+        with replicas.primary():
+            return compute()
+
+    def drop(self, *keys):
+        # Solo in questo processo, senza toccare i file di versione
+        self.cache.invalidate(*keys)
+
+    def invalidate(self, *keys):
+        self.cache.invalidate(*keys)
+        for key in keys:
+            self.stamp(key).touch()
+
+dashboard = Dashboard(300)
+
+def init_app(app):
+    dashboard.init_app(app)
+
+def snapshot(obj):
+    # Copia dei soli valori: gli oggetti ORM non sopravvivono alla sessione della richiesta
+    return SimpleNamespace(**{c.key: getattr(obj, c.key) for c in obj.__table__.columns})
+
+def _book_stats():
+    genres = Libro.query.with_entities(Libro.genere, func.count(Libro.genere)).group_by(Libro.genere).order_by(Libro.genere).all()
+    tbooks, tviews, tdowns = db.session.query(func.count(Libro.id), func.sum(Libro.viste), func.sum(Libro.download)).one()
+    mbooks = [snapshot(book) for book in Libro.query.order_by(Libro.viste.desc()).limit(5).all()]
+    return {
+        'genres': [tuple(genre) for genre in genres],
+        'stats': {'tbooks': tbooks, 'tviews': tviews or 0, 'tdowns': tdowns or 0, 'mbooks': mbooks}
+    }
+
+def _book_of_month():
+    month = Libro.query.filter_by(libro_mese="Si").first()
+    if not month:
+        return None, {}
+    end = db.session.query(func.max(Prestito.rientro)).filter(Prestito.libro_id == month.id, Prestito.terminato == "No").scalar()
+    return snapshot(month), {month.id: end.strftime('%d-%m-%Y') if end else ''}
+
+def _course_stats():
+    tview = db.session.query(func.sum(Corso.viste)).scalar() or 0
+    mcourses = [snapshot(course) for course in Corso.query.order_by(Corso.viste.desc()).limit(3).all()]
+    return {'tview': tview, 'mcourses': mcourses}
+
+def month(column):
+    # 'YYYY-MM' calcolato dal database
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return func.strftime('%Y-%m', column)
+    if dialect == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.date_format(column, '%Y-%m')
+
+def book_report(id, start=None, end=None):
+    # Statistiche di un libro con soli GROUP BY; la serie mensile si limita all'intervallo richiesto
+    total_loans = db.session.query(func.count(Prestito.id)).filter(Prestito.libro_id == id).scalar()
+
+    rating_distribution = {i: 0 for i in range(1, 6)}
+    ratings = db.session.query(Review.rating, func.count(Review.id)).filter(Review.libro_id == id).group_by(Review.rating).all()
+    for rating, count in ratings:
+        rating_distribution[rating] = count
+    reviews = sum(rating_distribution.values())
+    average_rating = sum(rating * count for rating, count in rating_distribution.items()) / reviews if reviews else 0
+
+    period = month(Prestito.uscita)
+    query = db.session.query(period, func.count(Prestito.id)).filter(Prestito.libro_id == id)
+    if start:
+        query = query.filter(Prestito.uscita >= start)
+    if end:
+        query = query.filter(Prestito.uscita <= end)
+    monthly_loans = dict(query.group_by(period).order_by(period).all())
+
+    return {
+        'total_loans': total_loans,
+        'average_rating': average_rating,
+        'rating_distribution': rating_distribution,
+        'monthly_loans': monthly_loans
+    }
+
+def _course_report():
+    # Un solo LEFT JOIN raggruppato per corso, con le prenotazioni divise per stato
+    state = lambda name: func.sum(case((Booking.state == name, 1), else_=0))
+    rows = db.session.query(Corso.id, Corso.nome, Corso.iscrizioni, Corso.massimo, Corso.viste,
+        func.count(Booking.id), state('Pending'), state('Confirmed'), state('Rejected')) \
+        .outerjoin(Booking, Booking.corso_id == Corso.id).group_by(Corso.id).order_by(Corso.id).all()
+
+    stats = []
+    for id, nome, iscrizioni, massimo, viste, bookings, pending, confirmed, rejected in rows:
+        stats.append({
+            'id': id,
+            'corso': nome,
+            'prenotazioni': bookings,
+            'pending': pending or 0,
+            'confirmed': confirmed or 0,
+            'rejected': rejected or 0,
+            'iscrizioni': iscrizioni,
+            'posti_max': massimo,
+            'riempimento': round(iscrizioni / massimo * 100, 2) if massimo else 0,
+            'viste': viste
+        })
+    return {'stats': stats, 'total_bookings': sum(stat['prenotazioni'] for stat in stats)}
+
+def course_report():
+    return dashboard.get('occupancy', _course_report)
+
+def book_stats():
+    return dashboard.get('books', _book_stats)
+
+def book_of_month():
+    return dashboard.get('month', _book_of_month)
+
+def course_stats():
+    return dashboard.get('courses', _course_stats)
+
+@on_commit(Libro)
+def books_changed(changes):
+    dashboard.invalidate('books', 'month')
+
+# Copie e data di rientro del libro del mese dipendono dai prestiti, il resto no
+@on_commit(Prestito, counters(Libro))
+def loans_changed(changes):
+    dashboard.invalidate('month')
+
+@on_commit(Corso)
+def courses_changed(changes):
+    dashboard.invalidate('courses')
+
+@on_commit(Corso, counters(Corso), Booking)
+def bookings_changed(changes):
+    dashboard.invalidate('occupancy')
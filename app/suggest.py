@@ -0,0 +1,174 @@
+from sqlalchemy.exc import SQLAlchemyError
+from .search import tokenize
+from .utils import Stamp
+from .replica import replicas
+import bisect, heapq, os, tempfile, threading, time
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+class Autocomplete:
+    # Array ordinato dei suffissi (a partire da ogni parola) cercato con bisect
+    def __init__(self, model, column, k=10, cache=2048):
+        self.model = model
+        self.column = column
+        self.k = k
+        self.size = cache
+        self.lock = threading.RLock()
+        self.building = threading.Lock()
+        self.stamp = Stamp(os.path.join(tempfile.gettempdir(), 'library-suggest-%s.stamp' % model.lower()))
+        self.seen = None
+        self.interval = 300
+        self.ranked = 0
+        self.clear()
+
+    def init_app(self, app):
+        directory = app.config.get('SUGGEST_STAMP_DIR')
+        if directory:
+            self.stamp.path = os.path.join(directory, os.path.basename(self.stamp.path))
+        self.interval = app.config.get('SUGGEST_RERANK', self.interval)
+        with app.app_context():
+            try:
+                self.rebuild()
+            except SQLAlchemyError as e:
+                app.logger.warning("Suggerimenti per %s non costruiti: %s", self.model, e)
+
+    def clear(self):
+        self.entries = []
+        self.records = {}
+        self.cache = {}
+        self.hot = {}
+
+    def rank(self, ids):
+        return heapq.nlargest(self.k, ids, key=lambda id: (self.records[id][1], -id))
+
+    def scan(self, prefix):
+        matches = set()
+        i = bisect.bisect_left(self.entries, (prefix,))
+        while i < len(self.entries) and self.entries[i][0].startswith(prefix):
+            matches.add(self.entries[i][1])
+            i += 1
+        return self.rank(matches)
+
+    def keys(self, label):
+        tokens = tokenize(label)
+        return [' '.join(tokens[i:]) for i in range(len(tokens))]
+
+    def rebuild(self):
+        from . import models
+        model = getattr(models, self.model)
+        # Versione letta prima della query, come per l'indice di ricerca
+        version = self.stamp.version()
+        with replicas.primary():
+            rows = model.query.with_entities(model.id, getattr(model, self.column), model.viste).all()
+        with self.lock:
+            self.clear()
+            for id, label, viste in rows:
+                keys = self.keys(label)
+                self.records[id] = (label, viste or 0, keys)
+                self.entries.extend((key, id) for key in keys)
+            self.entries.sort()
+            self.precompute()
+            self.seen = version
+            self.ranked = time.monotonic()
+
+    def precompute(self):
+        # I prefissi di una o due lettere coprono gran parte dell'array: li precalcoliamo
+        short = {}
+        for key, id in self.entries:
+            for prefix in {key[:1], key[:2]}:
+                short.setdefault(prefix, set()).add(id)
+        self.hot = {prefix: self.rank(ids) for prefix, ids in short.items()}
+
+    def rerank(self):
+        # Le viste crescono con i flush dei contatori: ogni SUGGEST_RERANK secondi si rileggono solo quelle
+        from . import models
+        model = getattr(models, self.model)
+        with replicas.primary():
+            rows = model.query.with_entities(model.id, model.viste).all()
+        with self.lock:
+            for id, viste in rows:
+                record = self.records.get(id)
+                if record:
+                    self.records[id] = (record[0], viste or 0, record[2])
+            self.cache.clear()
+            self.precompute()
+            self.ranked = time.monotonic()
+
+    def changed(self):
+        # Modifiche fatte da un altro processo: si ricostruisce l'array, una volta sola anche con più richieste in attesa
+        if self.stamp.version() != self.seen:
+            with self.building:
+                if self.stamp.version() != self.seen:
+                    self.rebuild()
+        elif self.interval and time.monotonic() - self.ranked > self.interval:
+            with self.building:
+                if time.monotonic() - self.ranked > self.interval:
+                    self.rerank()
+
+    def publish(self):
+        current = self.stamp.version() == self.seen
+        version = self.stamp.touch()
+        if current:
+            self.seen = version
+
+    def invalidate(self):
+        self.stamp.touch()
+
+    def add(self, record):
+        with self.lock:
+            self._remove(record.id)
+            label = getattr(record, self.column)
+            keys = self.keys(label)
+            self.records[record.id] = (label, int(record.viste or 0), keys)
+            for key in keys:
+                bisect.insort(self.entries, (key, record.id))
+                for prefix in {key[:1], key[:2]}:
+                    if prefix in self.hot:
+                        self.hot[prefix] = self.rank(set(self.hot[prefix]) | {record.id})
+            self.cache.clear()
+            self.publish()
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+            self.cache.clear()
+            self.publish()
+
+    def _remove(self, id):
+        record = self.records.pop(id, None)
+        if not record:
+            return
+        for key in record[2]:
+            i = bisect.bisect_left(self.entries, (key, id))
+            if i < len(self.entries) and self.entries[i] == (key, id):
+                del self.entries[i]
+            for prefix in {key[:1], key[:2]}:
+                if id in self.hot.get(prefix, ()):
+                    del self.hot[prefix]
+
+    def complete(self, query, k=None):
+        # I k risultati più visti che contengono una parola che inizia per la query
+        self.changed()
+        k = min(k or self.k, self.k)
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        with self.lock:
+            if len(prefix) <= 2:
+                ids = self.hot.get(prefix)
+                if ids is None:
+                    ids = self.hot[prefix] = self.scan(prefix)
+                return [{'id': id, self.column: self.records[id][0]} for id in ids[:k]]
+
+            ids = self.cache.pop(prefix, None)
+            if ids is None:
+                ids = self.scan(prefix)
+                if len(self.cache) >= self.size:
+                    self.cache.pop(next(iter(self.cache)))
+            self.cache[prefix] = ids
+            return [{'id': id, self.column: self.records[id][0]} for id in ids[:k]]
+
+book_titles = Autocomplete('Libro', 'titolo')
+course_names = Autocomplete('Corso', 'nome')
@@ -0,0 +1,53 @@
+from sqlalchemy.orm import make_transient_to_detached
+from .models import Utente
+from .events import on_commit
+from .utils import TTLCache, Stamp
+from .replica import replicas
+from . import db
+import os, tempfile
+
+class UserCache:
+    # Utenti di sessione per il user_loader: una lettura dal database ogni TTL invece che a ogni richiesta
+    def __init__(self):
+        self.cache = TTLCache(60, 10000)
+        self.stamp = Stamp(os.path.join(tempfile.gettempdir(), 'library-users.stamp'))
+        self.seen = None
+
+    def init_app(self, app):
+        self.cache.ttl = app.config.get('USER_CACHE_TTL', self.cache.ttl)
+        self.cache.size = app.config.get('USER_CACHE_SIZE', self.cache.size)
+        self.stamp.path = app.config.get('USER_CACHE_STAMP', self.stamp.path)
+
+    def changed(self):
+        # Il file segnala le modifiche fatte dagli altri processi: un solo stat, nessuna query
+        version = self.stamp.version()
+        if version != self.seen:
+            self.cache.clear()
+            self.seen = version
+
+    def values(self, id):
+        # Dal primario: una replica in ritardo rimetterebbe in cache il ruolo di prima per tutto il TTL
+        with replicas.primary():
+            user = db.session.get(Utente, id)
+        return {c.key: getattr(user, c.key) for c in Utente.__table__.columns} if user else None
+
+    def get(self, id):
+        self.changed()
+        values = self.cache.get(id, lambda: self.values(id))
+        if values is None:
+            return None
+        # Copia nella sessione della richiesta senza query, così le route possono modificarla e salvarla
+        user = Utente(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, *ids):
+        self.cache.invalidate(*ids)
+        self.stamp.touch()
+        self.seen = None
+
+users = UserCache()
+
+@on_commit(Utente)
+def users_changed(changes):
+    users.invalidate(*(id for model, id in changes))
@@ -1,6 +1,10 @@
 from xhtml2pdf import pisa
-from .models import Utente, Ratings
-import tempfile, re
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+from .models import Utente, Libro, Ratings, Prestito, Review
+from . import db
+from .pdf import jobs
+import os, tempfile, re, threading, time
 
 def check_password(password : str):
     if len(password) < 8:
@@ -22,7 +26,8 @@ def check_email(email : str):
 
 
 def convert(source):
-    pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    jobs.cleanup()
+    pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=jobs.directory)
     pisa_status = pisa.CreatePDF(source, dest=pdf)
     if pisa_status.err:
         print("Errore durante la creazione del PDF:", pisa_status.err)
@@ -35,4 +40,86 @@ def calculate_average_rating(course_id):
     if ratings:
         avg_rating = sum([r.rating for r in ratings]) / len(ratings)
         return round(avg_rating, 2)
-    return None
\ No newline at end of file
+    return None
+
+def load_cards(query, top=3, order=None):
+    # Carica libri, date di rientro e recensioni con un numero fisso di query
+    books = query.all()
+    if order is not None:
+        position = {id: i for i, id in enumerate(order)}
+        books.sort(key=lambda book: position[book.id])
+    ids = query.with_entities(Libro.id).order_by(None).subquery()
+
+    ends = {book.id: '' for book in books}
+    loans = db.session.query(Prestito.libro_id, func.max(Prestito.rientro)) \
+        .filter(Prestito.libro_id.in_(db.select(ids.c.id)), Prestito.terminato == "No") \
+        .group_by(Prestito.libro_id).all()
+    for libro_id, rientro in loans:
+        ends[libro_id] = rientro.strftime('%d-%m-%Y')
+
+    reviews = {book.id: [] for book in books}
+    rank = func.row_number().over(partition_by=Review.libro_id, order_by=Review.id).label('pos')
+    ranked = db.session.query(Review.id, rank).filter(Review.libro_id.in_(db.select(ids.c.id))).subquery()
+    revs = Review.query.options(joinedload(Review.utente)) \
+        .join(ranked, ranked.c.id == Review.id).filter(ranked.c.pos <= top).order_by(Review.id).all()
+    for review in revs:
+        reviews[review.libro_id].append(review)
+
+    return books, ends, reviews
+
+
+class TTLCache:
+    # Cache in memoria con scadenza e, se indicata, dimensione massima (LRU)
+    def __init__(self, ttl, size=None):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.data = {}
+        self.generation = 0
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry and entry[0] > now:
+                self.data[key] = entry
+                return entry[1]
+            generation = self.generation
+        value = compute()
+        with self.lock:
+            # Un invalidate arrivato durante il calcolo rende il valore già vecchio: lo si restituisce senza salvarlo
+            if generation != self.generation:
+                return value
+            self.data[key] = (now + self.ttl, value)
+            if self.size and len(self.data) > self.size:
+                self.data.pop(next(iter(self.data)))
+        return value
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.data.clear()
+
+class Stamp:
+    # File il cui mtime fa da numero di versione condiviso tra i processi
+    def __init__(self, path):
+        self.path = path
+
+    def version(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def touch(self):
+        # Sempre in avanti, anche se due scritture cadono nello stesso istante
+        ns = max(time.time_ns(), self.version() + 1)
+        with open(self.path, 'a'):
+            os.utime(self.path, ns=(ns, ns))
+        return ns
\ No newline at end of file
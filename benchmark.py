@@ -0,0 +1,310 @@
+# Benchmark delle route più usate su un catalogo sintetico.
+#   python benchmark.py                          SQLite temporaneo, dataset di default
+#   python benchmark.py --books 20000 --loans 200000 --threads 16 --duration 30
+#   python benchmark.py --save baseline.json     salva i risultati come riferimento
+#   python benchmark.py --compare baseline.json  confronta con un riferimento (exit 1 se peggiora)
+#   python benchmark.py --database mysql://user:pw@localhost/bench   database vuoto e usa e getta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+import argparse, json, os, platform, random, statistics, sys, tempfile, threading, time, tracemalloc
+
+# PDF di tutti gli utenti o di tutti i prestiti: decine di secondi o minuti a render con i volumi di default,
+# quindi esclusi dal giro di default e misurati solo se scelti con --only (es. --only pdf)
+SLOW = {'pdf uprint', 'pdf ldownload'}
+GENRES = ['Romanzo', 'Giallo', 'Fantasy', 'Storia', 'Saggio', 'Poesia', 'Fantascienza', 'Biografia', 'Ragazzi', 'Arte']
+WORDS = ['notte', 'città', 'mare', 'tempo', 'amore', 'guerra', 'isola', 'ombra', 'viaggio', 'giardino', 'segreto', 'fiume',
+    'luce', 'silenzio', 'inverno', 'montagna', 'memoria', 'sogno', 'vento', 'strada', 'libro', 'casa', 'lettera', 'stella']
+
+def zipf(rng, n, s=1.1):
+    # Pochi elementi molto richiesti e una coda lunga, come nei prestiti reali
+    weights = [1 / (i + 1) ** s for i in range(n)]
+    return lambda k=1: rng.choices(range(n), weights=weights, k=k)
+
+def seed(db, args):
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from app.models import Utente, Libro, Corso, Prestito, Booking, Review, Ratings, Message
+    rng = random.Random(args.seed)
+    today = date.today()
+    chunk = lambda rows: [rows[i:i + 5000] for i in range(0, len(rows), 5000)]
+    def bulk(model, rows):
+        for part in chunk(rows):
+            db.session.execute(insert(model), part)
+        db.session.commit()
+
+    password = generate_password_hash('Benchmark1')
+    bulk(Utente, [{'nome': f'Utente {i}', 'email': f'utente{i}@bench.invalid', 'password': password, 'telefono': '000',
+        'ruolo': 'Manager' if i == 0 else 'Partner', 'genere': 'MF'[i % 2]} for i in range(args.users)])
+    authors = [f'{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}' for i in range(max(1, args.books // 8))]
+    pick_author, pick_genre = zipf(rng, len(authors)), zipf(rng, len(GENRES), 0.8)
+    bulk(Libro, [{'titolo': ' '.join(rng.choice(WORDS) for w in range(rng.randint(1, 4))).capitalize() + f' {i}',
+        'anno': rng.randint(1900, today.year), 'classificazione': f'{rng.randint(0, 999):03d}', 'posizione': f'S{rng.randint(1, 40)}',
+        'autore': authors[pick_author()[0]], 'genere': GENRES[pick_genre()[0]], 'collana': None, 'editore': rng.choice(['Einaudi', 'Adelphi', 'Mondadori', 'Feltrinelli']),
+        'note': '', 'copie': rng.randint(1, 5), 'disponibile': True, 'libro_mese': i == 0, 'rivista': rng.random() < 0.1,
+        'viste': 0, 'download': 0} for i in range(args.books)])
+    bulk(Corso, [{'nome': f'Corso {i}', 'programma': 'Programma', 'docente': 'Docente', 'giorno': 'Lunedì', 'lezioni': 8, 'note': '',
+        'inizio': today + timedelta(days=rng.randint(-60, 60)), 'minimo': 3, 'massimo': 40, 'prezzo': 50, 'tessera': 10,
+        'prenotazioni': 0, 'iscrizioni': 0, 'viste': 0} for i in range(args.courses)])
+
+    # Libri popolari e utenti assidui: la distribuzione dei prestiti segue una Zipf
+    pick_book, pick_user, pick_course = zipf(rng, args.books), zipf(rng, args.users, 0.7), zipf(rng, args.courses, 0.9)
+    loans = []
+    for i in range(args.loans):
+        uscita = today - timedelta(days=int(rng.expovariate(1 / 180)))
+        rientro = uscita + timedelta(days=rng.choice([15, 30, 30, 30, 45, 120]))
+        closed = rientro < today and rng.random() < 0.9
+        loans.append({'uscita': uscita, 'rientro': rientro, 'terminato': closed, 'restituito': closed, 'prorogato': rng.random() < 0.1,
+            'libro_id': pick_book()[0] + 1, 'utente_id': pick_user()[0] + 1})
+    bulk(Prestito, loans)
+    bulk(Booking, [{'state': rng.choice(['Pending', 'Confirmed', 'Confirmed', 'Rejected']), 'bdate': today - timedelta(days=rng.randint(0, 365)),
+        'corso_id': pick_course()[0] + 1, 'utente_id': pick_user()[0] + 1} for i in range(args.bookings)])
+    bulk(Review, [{'rating': min(5, max(1, round(rng.gauss(3.8, 1)))), 'comment': 'Recensione ' * rng.randint(1, 30),
+        'libro_id': pick_book()[0] + 1, 'utente_id': pick_user()[0] + 1} for i in range(args.reviews)])
+    bulk(Ratings, [{'rating': rng.randint(1, 5), 'comment': 'Commento', 'corso_id': pick_course()[0] + 1,
+        'utente_id': pick_user()[0] + 1} for i in range(args.ratings)])
+    bulk(Message, [{'titolo': f'Avviso {i}', 'corpo': 'Testo', 'msgdate': datetime.now() - timedelta(days=i)} for i in range(20)])
+
+    from app.search import index
+    from app.suggest import book_titles, course_names
+    index.rebuild()
+    book_titles.rebuild()
+    course_names.rebuild()
+
+class Queries:
+    # Conta le query del thread corrente, cioè della richiesta in corso nel test client
+    def __init__(self):
+        self.local = threading.local()
+
+    def __call__(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+def endpoints(db, args):
+    from app.models import Libro, Prestito
+    rng = random.Random(args.seed + 1)
+    available = db.session.query(Libro.id, Libro.titolo).filter(Libro.copie > 0).limit(2000).all()
+    authors = [author for author, in db.session.query(Libro.autore).distinct().limit(500)]
+    hot = zipf(rng, args.books)
+    open_loans = [id for id, in db.session.query(Prestito.id).filter(Prestito.terminato == "No").order_by(Prestito.id.desc()).limit(5000)]
+    word = lambda: rng.choice(WORDS)
+    today = date.today().isoformat()
+
+    # nome: (peso nel carico misto, anonimo, funzione che restituisce metodo, url e dati del form)
+    return {
+        'suggest': (10, True, lambda: ('get', f'/suggest?query={word()[:rng.randint(1, 4)]}', None)),
+        'search titolo': (6, False, lambda: ('post', '/book/search/titolo', {'titolo': word()})),
+        'search autore': (3, False, lambda: ('post', '/book/search/autore', {'autore': rng.choice(authors)})),
+        'book (anonimo)': (8, True, lambda: ('get', '/book', None)),
+        'book': (4, False, lambda: ('get', '/book', None)),
+        'lall': (3, False, lambda: ('get', '/loan/all', None)),
+        'bstats': (2, False, lambda: ('get', f'/book/{hot()[0] + 1}/stats', None)),
+        'lstats': (2, False, lambda: ('get', '/loan/stats', None)),
+        'pstats': (1, False, lambda: ('get', '/booking/stats', None)),
+        'lalerts': (1, False, lambda: ('get', '/loan/reports/alerts', None)),
+        'export loans.csv': (0, False, lambda: ('get', '/export/loans.csv?filter=overdue', None)),
+        'pdf bdownload': (0, False, lambda: ('get', f'/book/{hot()[0] + 1}/download', None)),
+        'pdf lprint': (0, False, lambda: ('get', '/loan/print', None)),
+        # PDF in coda: la latenza va dalla richiesta al file pronto; bprint e cprint dalla seconda volta escono dalla cache
+        'pdf bprint': (0, False, lambda: ('get', f'/book/{GENRES[hot()[0] % len(GENRES)]}/print', None)),
+        'pdf cprint': (0, False, lambda: ('get', '/course/print', None)),
+        'pdf uprint': (0, False, lambda: ('get', '/user/print', None)),
+        'pdf ldownload': (0, False, lambda: ('get', '/loan/download', None)),
+        'lcreate': (1, False, lambda: ('post', '/loan/create', dict(zip(('libro_id', 'titolo'), rng.choice(available)), uscita=today))),
+        'lterm': (1, False, lambda: ('get', f'/loan/{open_loans.pop() if open_loans else 0}/term', None)),
+    }
+
+def client(app, anonymous):
+    c = app.test_client()
+    if not anonymous:
+        with c.session_transaction() as s:
+            s['_user_id'] = '1'
+            s['_fresh'] = True
+    return c
+
+def call(c, spec):
+    method, url, data = spec()
+    response = getattr(c, method)(url, data=data, headers={'Accept': 'application/json'})
+    response.get_data()
+    if response.status_code == 202:
+        return wait(c, response.get_json())
+    return response.status_code
+
+def wait(c, job, timeout=600):
+    # I PDF in coda si misurano fino al file pronto, come li vede l'utente che aspetta
+    stop = time.perf_counter() + timeout
+    while time.perf_counter() < stop:
+        status = c.get(job['status']).get_json()
+        if status['status'] == 'done':
+            return c.get(status['download']).status_code
+        if status['status'] == 'failed':
+            return 500
+        time.sleep(0.05)
+    return 504
+
+def percentiles(times):
+    times = sorted(times)
+    pick = lambda p: times[min(len(times) - 1, int(p / 100 * len(times)))] * 1000
+    return {'p50': round(pick(50), 2), 'p95': round(pick(95), 2), 'p99': round(pick(99), 2),
+        'mean': round(statistics.mean(times) * 1000, 2), 'max': round(times[-1] * 1000, 2)}
+
+def measure(app, routes, queries, args):
+    # Richieste in sequenza: latenze, query per richiesta e picco di memoria Python di una richiesta
+    results = {}
+    for name, (weight, anonymous, spec) in routes.items():
+        if args.only and args.only not in name or name in SLOW and not args.only:
+            continue
+        c = client(app, anonymous)
+        n = max(3, args.requests // 10) if name.startswith('pdf') else args.requests
+        call(c, spec)
+        times, counts, errors = [], [], 0
+        for i in range(n):
+            queries.reset()
+            start = time.perf_counter()
+            status = call(c, spec)
+            times.append(time.perf_counter() - start)
+            counts.append(queries.count())
+            errors += status >= 500
+        tracemalloc.start()
+        call(c, spec)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = dict(percentiles(times), requests=n, errors=errors, queries=round(statistics.mean(counts), 1),
+            peak_kb=round(peak / 1024))
+        r = results[name]
+        print(f"{name:<18} p50 {r['p50']:>8.2f} ms  p95 {r['p95']:>8.2f} ms  p99 {r['p99']:>8.2f} ms  "
+            f"query {r['queries']:>6}  picco {r['peak_kb']:>7} KB  errori {errors}")
+    return results
+
+def load(app, routes, args):
+    # Carico misto da più thread per --duration secondi, con i pesi di endpoints()
+    mix = [(name, weight, anonymous, spec) for name, (weight, anonymous, spec) in routes.items()
+        if weight and (not args.only or args.only in name)]
+    if not mix:
+        return None
+    weights = [weight for name, weight, anonymous, spec in mix]
+    times, errors, lock = [], [0], threading.Lock()
+    stop = time.perf_counter() + args.duration
+
+    def worker(i):
+        rng = random.Random(args.seed + 100 + i)
+        clients = {anonymous: client(app, anonymous) for anonymous in (True, False)}
+        local = []
+        while time.perf_counter() < stop:
+            name, weight, anonymous, spec = rng.choices(mix, weights=weights)[0]
+            start = time.perf_counter()
+            try:
+                status = call(clients[anonymous], spec)
+            except Exception:
+                status = 500
+            local.append(time.perf_counter() - start)
+            if status >= 500:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            times.extend(local)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(worker, range(args.threads)))
+    elapsed = time.perf_counter() - start
+    result = dict(percentiles(times), requests=len(times), errors=errors[0], threads=args.threads,
+        throughput=round(len(times) / elapsed, 1))
+    print(f"\ncarico misto, {args.threads} thread: {result['throughput']} richieste/s, p50 {result['p50']} ms, "
+        f"p95 {result['p95']} ms, p99 {result['p99']} ms, errori {result['errors']}")
+    return result
+
+def compare(results, path, tolerance):
+    # Peggioramenti oltre la tolleranza su p95, throughput o numero di query
+    with open(path) as f:
+        baseline = json.load(f)
+    worse = []
+    print(f'\nconfronto con {path} (tolleranza {tolerance:.0%})')
+    for name, r in results['endpoints'].items():
+        b = baseline['endpoints'].get(name)
+        if not b:
+            continue
+        delta = (r['p95'] - b['p95']) / b['p95'] if b['p95'] else 0
+        flag = ''
+        if delta > tolerance or r['queries'] > b['queries']:
+            flag = '  <-- peggiorato'
+            worse.append(name)
+        print(f"{name:<18} p95 {b['p95']:>8.2f} -> {r['p95']:>8.2f} ms ({delta:+.0%})  query {b['queries']} -> {r['queries']}{flag}")
+    if results.get('load') and baseline.get('load'):
+        b, r = baseline['load'], results['load']
+        delta = (r['throughput'] - b['throughput']) / b['throughput'] if b['throughput'] else 0
+        flag = '  <-- peggiorato' if delta < -tolerance else ''
+        if flag:
+            worse.append('carico misto')
+        print(f"{'carico misto':<18} {b['throughput']} -> {r['throughput']} richieste/s ({delta:+.0%}){flag}")
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', help='URL di un database vuoto e usa e getta (default: SQLite temporaneo)')
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--courses', type=int, default=50)
+    parser.add_argument('--bookings', type=int, default=5000)
+    parser.add_argument('--reviews', type=int, default=20000)
+    parser.add_argument('--ratings', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=50, help='richieste in sequenza per endpoint')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='secondi di carico misto (0 per saltarlo)')
+    parser.add_argument('--only', help='solo gli endpoint il cui nome contiene questo testo')
+    parser.add_argument('--save', help='file JSON in cui salvare i risultati')
+    parser.add_argument('--compare', help='file JSON di riferimento da confrontare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Config legge l'ambiente all'import: il database va scelto prima di importare l'app
+    directory = tempfile.mkdtemp(prefix='library-bench-')
+    os.environ['DATABASE_URL'] = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+    os.environ.pop('REPLICA_DATABASE_URL', None)
+    from sqlalchemy import event
+    from app import create_app, db
+    from app.models import Libro
+
+    app = create_app()
+    queries = Queries()
+    with app.app_context():
+        db.create_all()
+        if db.session.query(Libro.id).first():
+            sys.exit('Il database non è vuoto: il benchmark va eseguito su un database usa e getta.')
+        start = time.perf_counter()
+        seed(db, args)
+        print(f'dataset: {args.books} libri, {args.users} utenti, {args.loans} prestiti, {args.bookings} prenotazioni, '
+            f'{args.reviews} recensioni in {time.perf_counter() - start:.1f}s ({db.engine.dialect.name})\n')
+        event.listen(db.engine, 'before_cursor_execute', queries)
+        routes = endpoints(db, args)
+
+    results = {
+        'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'database': os.environ['DATABASE_URL'].split(':')[0],
+            'dataset': {name: getattr(args, name) for name in ('books', 'users', 'loans', 'courses', 'bookings', 'reviews', 'ratings', 'seed')}},
+        'endpoints': measure(app, routes, queries, args),
+        'load': load(app, routes, args) if args.duration else None
+    }
+    try:
+        import resource
+        results['meta']['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"memoria massima del processo: {results['meta']['max_rss_kb']} KB")
+    except ImportError:
+        pass
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'risultati salvati in {args.save}')
+    if args.compare:
+        worse = compare(results, args.compare, args.tolerance)
+        sys.exit(1 if worse else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Piani di esecuzione delle query più frequenti delle route.
+#   python explain.py            piani con lo schema attuale
+#   python explain.py --migrate  piani prima e dopo `flask db upgrade`
+from datetime import date, timedelta
+from sqlalchemy import func
+from app import create_app, db
+from app.models import Libro, Prestito, Booking, Review, Message
+import sys
+
+def queries():
+    today = date.today()
+    return {
+        'load_cards (rientro)': db.session.query(Prestito.libro_id, func.max(Prestito.rientro))
+            .filter(Prestito.libro_id.in_([1, 2, 3]), Prestito.terminato == "No").group_by(Prestito.libro_id),
+        'load_cards (reviews)': Review.query.filter(Review.libro_id.in_([1, 2, 3])),
+        'bview': Libro.query.filter(Libro.genere == 'Romanzo').order_by(Libro.titolo),
+        'bauthor': Libro.query.filter(Libro.autore == 'Italo Calvino'),
+        'book (top 5)': Libro.query.order_by(Libro.viste.desc()).limit(5),
+        'book (libro del mese)': Libro.query.filter_by(libro_mese="Si"),
+        'bstats (mesi)': Prestito.query.filter(Prestito.libro_id == 1, Prestito.uscita >= today - timedelta(days=730)),
+        'bstats (voti)': db.session.query(Review.rating, func.count(Review.id)).filter(Review.libro_id == 1).group_by(Review.rating),
+        'uprofile': Prestito.query.filter_by(utente_id=1, terminato="No"),
+        'loverdue': Prestito.query.filter(Prestito.rientro < today, Prestito.restituito == "No"),
+        'lexpiring': Prestito.query.filter(Prestito.rientro <= today + timedelta(days=7), Prestito.rientro >= today),
+        'lbhistory': Prestito.query.filter_by(libro_id=1).order_by(Prestito.id),
+        'ppending': Booking.query.filter_by(state='Pending'),
+        'pstats': db.session.query(Booking.corso_id, Booking.state, func.count(Booking.id)).group_by(Booking.corso_id, Booking.state),
+        'home (messaggi)': Message.query.order_by(Message.msgdate.desc()).limit(5),
+    }
+
+def explain():
+    dialect = db.engine.dialect
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    for name, query in queries().items():
+        sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+        print(f'--- {name}')
+        for row in db.session.execute(db.text(prefix + sql)):
+            print('   ', ' | '.join(str(v) for v in row))
+    print()
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        if '--migrate' in sys.argv:
+            from flask_migrate import upgrade
+            print('=== Prima')
+            explain()
+            upgrade()
+            db.session.remove()
+            print('=== Dopo')
+        explain()
@@ -0,0 +1,59 @@
+"""Indici per i filtri e gli ordinamenti usati dalle route
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 15:40:00
+
+Non crea le tabelle di base: su un database esistente basta `flask db upgrade`.
+Un database nuovo creato con db.create_all() ha già questi indici, quindi va
+solo marcato con `flask db stamp head`.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_prestito_libro_terminato_rientro', 'prestito', ['libro_id', 'terminato', 'rientro']),
+    ('ix_prestito_libro_uscita', 'prestito', ['libro_id', 'uscita']),
+    ('ix_prestito_utente_terminato', 'prestito', ['utente_id', 'terminato']),
+    ('ix_prestito_restituito_rientro', 'prestito', ['restituito', 'rientro']),
+    ('ix_prestito_rientro', 'prestito', ['rientro']),
+    ('ix_prestito_uscita', 'prestito', ['uscita']),
+    ('ix_booking_corso_state', 'booking', ['corso_id', 'state']),
+    ('ix_booking_state', 'booking', ['state']),
+    ('ix_booking_utente', 'booking', ['utente_id']),
+    ('ix_review_libro_rating', 'review', ['libro_id', 'rating']),
+    ('ix_ratings_corso', 'ratings', ['corso_id']),
+    ('ix_libro_genere_titolo', 'libro', ['genere', 'titolo']),
+    ('ix_libro_autore', 'libro', ['autore']),
+    ('ix_libro_libro_mese', 'libro', ['libro_mese']),
+    ('ix_libro_viste', 'libro', ['viste']),
+    ('ix_message_msgdate', 'message', ['msgdate']),
+]
+
+
+def upgrade():
+    # Il riepilogo giornaliero dei prestiti è stato aggiunto ai modelli prima delle migrazioni
+    if not sa.inspect(op.get_bind()).has_table('prestito_giornaliero'):
+        op.create_table('prestito_giornaliero',
+            sa.Column('giorno', sa.Date(), nullable=False),
+            sa.Column('prestiti', sa.Integer(), nullable=False),
+            sa.Column('giorni', sa.Integer(), nullable=False),
+            sa.Column('insoliti', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('giorno')
+        )
+
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,78 @@
+"""Flag Si/No come booleani e anno come intero
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 18:10:00
+
+I valori "Si" diventano true e tutti gli altri false; gli anni che non sono
+un numero diventano NULL. Route e template continuano a vedere "Si"/"No"
+grazie al tipo SiNo dei modelli.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+FLAGS = {
+    'prestito': [('terminato', 2), ('restituito', 2), ('prorogato', 2)],
+    'libro': [('disponibile', 255), ('libro_mese', 255), ('rivista', 255)],
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    postgresql = bind.dialect.name == 'postgresql'
+
+    for table, columns in FLAGS.items():
+        if not postgresql:
+            # '1'/'0' si convertono in booleano con un semplice cambio di tipo
+            for column, length in columns:
+                op.execute(f"UPDATE {table} SET {column} = CASE WHEN {column} = 'Si' THEN '1' ELSE '0' END")
+        with op.batch_alter_table(table) as batch:
+            for column, length in columns:
+                batch.alter_column(column, existing_type=sa.String(length), type_=sa.Boolean(),
+                    existing_nullable=False, postgresql_using=f"{column} = 'Si'")
+
+    # Anni non numerici o fuori scala: meglio NULL che un errore a metà conversione
+    with op.batch_alter_table('libro') as batch:
+        batch.alter_column('anno', existing_type=sa.String(255), nullable=True)
+    libro = sa.table('libro', sa.column('id', sa.Integer), sa.column('anno', sa.String))
+    for id, anno in bind.execute(sa.select(libro.c.id, libro.c.anno)).all():
+        value = (anno or '').strip()
+        value = int(value) if value.isdigit() and int(value) <= 32767 else None
+        if value is None or str(value) != anno:
+            bind.execute(libro.update().where(libro.c.id == id).values(anno=None if value is None else str(value)))
+    with op.batch_alter_table('libro') as batch:
+        batch.alter_column('anno', existing_type=sa.String(255), type_=sa.SmallInteger(),
+            existing_nullable=True, postgresql_using='anno::smallint')
+
+    op.create_index('ix_prestito_aperti', 'prestito', ['rientro'],
+        sqlite_where=sa.text('NOT restituito'), postgresql_where=sa.text('NOT restituito'))
+
+
+def downgrade():
+    bind = op.get_bind()
+    postgresql = bind.dialect.name == 'postgresql'
+    op.drop_index('ix_prestito_aperti', table_name='prestito')
+
+    with op.batch_alter_table('libro') as batch:
+        batch.alter_column('anno', existing_type=sa.SmallInteger(), type_=sa.String(255),
+            existing_nullable=True, postgresql_using='anno::text')
+    op.execute("UPDATE libro SET anno = '' WHERE anno IS NULL")
+    with op.batch_alter_table('libro') as batch:
+        batch.alter_column('anno', existing_type=sa.String(255), nullable=False)
+
+    for table, columns in FLAGS.items():
+        with op.batch_alter_table(table) as batch:
+            for column, length in columns:
+                batch.alter_column(column, existing_type=sa.Boolean(), type_=sa.String(length), existing_nullable=False,
+                    postgresql_using=f"CASE WHEN {column} THEN 'Si' ELSE 'No' END")
+        if not postgresql:
+            for column, length in columns:
+                op.execute(f"UPDATE {table} SET {column} = CASE WHEN {column} IN ('1', 'true') THEN 'Si' ELSE 'No' END")
@@ -0,0 +1,24 @@
+"""Indice sulla chiave naturale dei libri usata da `flask ingest`
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 19:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_libro_titolo_autore', 'libro', ['titolo', 'autore'])
+
+
+def downgrade():
+    op.drop_index('ix_libro_titolo_autore', table_name='libro')
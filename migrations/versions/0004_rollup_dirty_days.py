@@ -0,0 +1,28 @@
+"""Giorni del riepilogo dei prestiti da ricalcolare, salvati nel database
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 10:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('giorno_modificato',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('giorno', sa.Date(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('giorno_modificato')
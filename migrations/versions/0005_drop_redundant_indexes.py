@@ -0,0 +1,29 @@
+"""Rimuove l'indice doppione sui prestiti aperti
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 11:00:00
+
+ix_prestito_aperti ripete ix_prestito_restituito_rientro (e su MySQL è una copia
+completa di ix_prestito_rientro). ix_booking_state resta: ix_booking_corso_state
+non serve WHERE state = 'Pending' senza corso_id.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_prestito_aperti', table_name='prestito')
+
+
+def downgrade():
+    op.create_index('ix_prestito_aperti', 'prestito', ['rientro'],
+        sqlite_where=sa.text('NOT restituito'), postgresql_where=sa.text('NOT restituito'))
@@ -0,0 +1,112 @@
+# Prova di concorrenza sulle copie: molte richieste di prestito in parallelo sullo stesso titolo.
+#   python stress.py [--requests 300] [--copies 20] [--workers 50]
+# Usa il database di DATABASE_URL (meglio uno di prova): crea un libro e un utente e li elimina alla fine.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from app import create_app, db
+from app.models import Utente, Libro, Prestito
+from app.search import index
+from app import inventory
+import argparse, sys, time, uuid
+
+def client(app, user_id):
+    c = app.test_client()
+    with c.session_transaction() as s:
+        s['_user_id'] = str(user_id)
+        s['_fresh'] = True
+    return c
+
+def run(app, args):
+    tag = uuid.uuid4().hex[:8]
+    with app.app_context():
+        user = Utente(nome='stress ' + tag, email=tag + '@stress.invalid', password='-', telefono='-', ruolo='Partner', genere='-')
+        book = Libro(titolo='Stress ' + tag, anno=2000, classificazione='-', posizione='-', autore='-', genere='-', editore='-',
+            copie=args.copies, disponibile='Si', libro_mese='No', rivista='No', viste=0, download=0)
+        db.session.add_all([user, book])
+        db.session.commit()
+        index.add(book)
+        user_id, book_id, title = user.id, book.id, book.titolo
+
+    form = {'titolo': title, 'uscita': date.today().isoformat()}
+    def borrow(i):
+        return client(app, user_id).post('/loan/create', data=form).status_code
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            codes = list(pool.map(borrow, range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+        with app.app_context():
+            book = db.session.get(Libro, book_id)
+            loans = Prestito.query.filter_by(libro_id=book_id).all()
+            print(f'{args.requests} richieste in {elapsed:.2f}s, {len(loans)} prestiti su {args.copies} copie, '
+                f'copie rimaste {book.copie}, disponibile {book.disponibile}')
+            errors = [code for code in codes if code >= 500]
+            ok = len(loans) == min(args.requests, args.copies) and book.copie == args.copies - len(loans) and not errors
+            ok = ok and book.disponibile == ('No' if book.copie == 0 else 'Si')
+            loan_id = loans[0].id if loans else None
+
+        # La stessa restituzione ripetuta in parallelo deve rendere una sola copia
+        if loan_id:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                list(pool.map(lambda i: client(app, user_id).get(f'/loan/{loan_id}/term').status_code, range(args.workers)))
+            with app.app_context():
+                copie = db.session.get(Libro, book_id).copie
+                print(f'{args.workers} restituzioni parallele dello stesso prestito: copie rimaste {copie}')
+                ok = ok and copie == args.copies - len(loans) + 1
+        if errors:
+            print(f'{len(errors)} risposte con errore del server')
+        return ok
+    finally:
+        with app.app_context():
+            Prestito.query.filter_by(libro_id=book_id).delete()
+            Libro.query.filter_by(id=book_id).delete()
+            Utente.query.filter_by(id=user_id).delete()
+            db.session.commit()
+            index.remove(book_id)
+
+def availability(app):
+    # Il flag disponibile segue le copie con la semantica del database vero (su MySQL il SET va da sinistra a destra):
+    # 2 -> 1 copia resta disponibile, 1 -> 0 no, la restituzione lo riporta a Si
+    tag = uuid.uuid4().hex[:8]
+    with app.app_context():
+        user = Utente(nome='stress ' + tag, email=tag + '@stress.invalid', password='-', telefono='-', ruolo='Partner', genere='-')
+        book = Libro(titolo='Stress ' + tag, anno=2000, classificazione='-', posizione='-', autore='-', genere='-', editore='-',
+            copie=2, disponibile='Si', libro_mese='No', rivista='No', viste=0, download=0)
+        db.session.add_all([user, book])
+        db.session.commit()
+        user_id, book_id = user.id, book.id
+        try:
+            def state():
+                db.session.expire_all()
+                book = db.session.get(Libro, book_id)
+                return book.copie, book.disponibile
+            today = date.today()
+            steps = []
+            loan = inventory.lend(book_id, user_id, today, today)
+            steps.append((state(), (1, 'Si')))
+            inventory.lend(book_id, user_id, today, today)
+            steps.append((state(), (0, 'No')))
+            steps.append((inventory.lend(book_id, user_id, today, today), None))
+            inventory.terminate(loan.id, today)
+            steps.append((state(), (1, 'Si')))
+            for got, expected in steps:
+                print(f'copie e disponibile: {got}, atteso {expected}')
+            return all(got == expected for got, expected in steps)
+        finally:
+            db.session.rollback()
+            Prestito.query.filter_by(libro_id=book_id).delete()
+            Libro.query.filter_by(id=book_id).delete()
+            Utente.query.filter_by(id=user_id).delete()
+            db.session.commit()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--copies', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=50)
+    app = create_app()
+    ok = availability(app) and run(app, parser.parse_args())
+    print('OK' if ok else 'ERRORE: copie vendute oltre la disponibilità o contatori incoerenti')
+    sys.exit(0 if ok else 1)